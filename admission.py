@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict, deque
+
+from metrics import registry
+
+ADMISSION_WAIT = registry.histogram("admission_wait_seconds", "Ожидание в очереди к модели", ("model",))
+ADMISSION_REJECTED = registry.counter("admission_rejected_total", "Запросы, отклонённые с 429", ("reason",))
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__("Слишком много запросов, попробуйте через %d с" % math.ceil(retry_after))
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount=1):
+        # 0 — можно сейчас, иначе сколько секунд ждать до следующего токена
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, per_minute, burst, max_keys=10000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def check(self, key):
+        if self.rate <= 0:
+            return
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            # Давно не заходившие пользователи всё равно вернутся с полным ведром
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        wait = bucket.take()
+        if wait:
+            ADMISSION_REJECTED.inc("rate_limit")
+            raise Overloaded("rate_limit", wait)
+
+
+class FairScheduler:
+    # Взвешенная справедливая очередь (start-time fair queuing): у каждого потока
+    # (пользователя) своя метка окончания, первым обслуживается запрос с меньшей
+    # меткой старта — тот, кто спрашивал много, пропускает вперёд остальных
+    def __init__(self, capacity, max_queue, max_wait):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.queue = []
+        self.seq = itertools.count()
+        self.virtual_time = 0.0
+        self.finish = {}
+        self.service = deque(maxlen=100)
+        self.waits = deque(maxlen=100)
+
+    def depth(self):
+        return sum(1 for entry in self.queue if not entry[2].done())
+
+    def estimated_wait(self):
+        if self.active < self.capacity and not self.depth():
+            return 0.0
+        avg = sum(self.service) / len(self.service) if self.service else 10.0
+        return (self.depth() + 1) * avg / self.capacity
+
+    def check(self):
+        # Быстрый отказ до того, как запрос что-то сохранил
+        if self.depth() >= self.max_queue:
+            ADMISSION_REJECTED.inc("queue_full")
+            raise Overloaded("queue_full", self.estimated_wait())
+        if self.estimated_wait() > self.max_wait:
+            ADMISSION_REJECTED.inc("queue_wait")
+            raise Overloaded("queue_wait", self.estimated_wait())
+
+    def tag(self, flow, cost):
+        start = max(self.virtual_time, self.finish.get(flow, 0.0))
+        self.finish[flow] = start + cost
+        return start
+
+    def dispatch(self):
+        while self.queue and self.active < self.capacity:
+            start, _, future = heapq.heappop(self.queue)
+            if future.done():
+                continue
+            self.virtual_time = max(self.virtual_time, start)
+            self.active += 1
+            future.set_result(None)
+        if len(self.finish) > 1024:
+            self.finish = {flow: f for flow, f in self.finish.items() if f > self.virtual_time}
+
+    async def acquire(self, flow, cost=1.0, model=""):
+        queued = time.monotonic()
+        if self.active < self.capacity and not self.depth():
+            self.virtual_time = max(self.virtual_time, self.tag(flow, cost))
+            self.active += 1
+        else:
+            if self.depth() >= self.max_queue:
+                ADMISSION_REJECTED.inc("queue_full")
+                raise Overloaded("queue_full", self.estimated_wait())
+            start = self.tag(flow, cost)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.queue, (start, next(self.seq), future))
+            try:
+                await asyncio.wait({future}, timeout=self.max_wait)
+            except BaseException:
+                # Отмена уже после выдачи слота — слот надо вернуть
+                if future.done() and not future.cancelled():
+                    self.release(queued)
+                else:
+                    future.cancel()
+                raise
+            if not future.done():
+                future.cancel()
+                ADMISSION_REJECTED.inc("queue_timeout")
+                raise Overloaded("queue_timeout", self.estimated_wait())
+        waited = time.monotonic() - queued
+        self.waits.append(waited)
+        ADMISSION_WAIT.observe(waited, model)
+        return time.monotonic()
+
+    def release(self, acquired):
+        self.service.append(time.monotonic() - acquired)
+        self.active -= 1
+        self.dispatch()
+
+    def snapshot(self):
+        waits = sorted(self.waits)
+        return {
+            "active": self.active,
+            "capacity": self.capacity,
+            "queued": self.depth(),
+            "estimated_wait": round(self.estimated_wait(), 3),
+            "wait_p50": waits[len(waits) // 2] if waits else None,
+            "wait_p95": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else None,
+        }
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_jsonl(data, models, roles, max_items):
+    # Строка — {"prompt": ..., "model": ..., "role": ..., "id": ...}; ошибки — с номером строки
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise BatchError("файл не в UTF-8")
+    items = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise BatchError(f"строка {lineno}: не JSON")
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str) or not item["prompt"].strip():
+            raise BatchError(f"строка {lineno}: нужно непустое поле prompt")
+        model = item.get("model", "Qwen3 Coder")
+        role = item.get("role", "Ассистент")
+        if not isinstance(model, str) or model not in models:
+            raise BatchError(f"строка {lineno}: неизвестная модель {model}")
+        if not isinstance(role, str) or role not in roles:
+            raise BatchError(f"строка {lineno}: неизвестная роль {role}")
+        items.append({"id": str(item.get("id", len(items))), "prompt": item["prompt"], "model": model, "role": role})
+        if len(items) > max_items:
+            raise BatchError(f"не больше {max_items} запросов в одной задаче")
+    if not items:
+        raise BatchError("пустой файл")
+    return items
+
+
+class BatchStore:
+    # Задачи и готовые результаты; по ним задача продолжается после разрыва или рестарта
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS batch_jobs (id TEXT PRIMARY KEY, items TEXT NOT NULL, created REAL NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS batch_results ("
+            " job_id TEXT NOT NULL, idx INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (job_id, idx))"
+        )
+
+    def create(self, items):
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.db.execute("INSERT INTO batch_jobs (id, items, created) VALUES (?, ?, ?)",
+                            (job_id, json.dumps(items, ensure_ascii=False), time.time()))
+        return job_id
+
+    def items(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT items FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def results(self, job_id):
+        with self.lock:
+            rows = self.db.execute("SELECT idx, data FROM batch_results WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        return {idx: json.loads(data) for idx, data in rows}
+
+    def put_result(self, job_id, idx, result):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO batch_results (job_id, idx, data) VALUES (?, ?, ?)",
+                            (job_id, idx, json.dumps(result, ensure_ascii=False)))
+
+    def purge(self, ttl):
+        cutoff = time.time() - ttl
+        with self.lock:
+            self.db.execute("DELETE FROM batch_results WHERE job_id IN (SELECT id FROM batch_jobs WHERE created < ?)", (cutoff,))
+            self.db.execute("DELETE FROM batch_jobs WHERE created < ?", (cutoff,))
+
+
+async def bounded_map(func, args, limit):
+    # Не больше limit вызовов одновременно; результаты отдаются по мере готовности.
+    # Ошибка элемента должна входить в его результат; если func всё же бросит
+    # исключение, оно дойдёт до читателя, а не повесит поток навсегда
+    args = iter(args)
+    done = asyncio.Queue()
+
+    async def worker():
+        try:
+            for arg in args:
+                await done.put(await func(arg))
+        except Exception as e:
+            await done.put(e)
+        finally:
+            done.put_nowait(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(limit)]
+    try:
+        running = limit
+        while running:
+            result = await done.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def jsonl_line(data):
+    return json.dumps(data, ensure_ascii=False) + "\n"
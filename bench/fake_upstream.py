@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Поддельный OpenAI-совместимый апстрим для нагрузочных тестов.
+# Настройки берутся из окружения, чтобы их можно было передать в подпроцесс uvicorn.
+CONFIG = {
+    "ttft": float(os.environ.get("FAKE_TTFT", "0.3")),
+    "tokens_per_sec": float(os.environ.get("FAKE_TOKENS_PER_SEC", "200")),
+    "reply_tokens": int(os.environ.get("FAKE_REPLY_TOKENS", "300")),
+    "error_rate": float(os.environ.get("FAKE_ERROR_RATE", "0")),
+    "jitter": float(os.environ.get("FAKE_JITTER", "0.1")),
+    # {"deepseek-ai/DeepSeek-R1": {"ttft": 5}} — переопределения для отдельных моделей
+    "per_model": json.loads(os.environ.get("FAKE_PER_MODEL", "{}")),
+}
+
+WORDS = ["функция", "данные", "запрос", "ответ", "модель", "список", "значение", "результат", "код", "пример"]
+CODE_BLOCK = "\n\n```python\ndef handler(request):\n    return {\"ok\": True}\n```\n\n"
+
+app = FastAPI()
+stats = {"requests": 0, "errors": 0, "streams": 0}
+
+
+def settings(model):
+    return dict(CONFIG, **CONFIG["per_model"].get(model, {}))
+
+
+def reply_tokens(n):
+    rng = random.Random(n)
+    tokens = []
+    for i in range(n):
+        if i and i % 120 == 0:
+            tokens.append(CODE_BLOCK)
+        elif i and i % 40 == 0:
+            tokens.append("\n\n")
+        else:
+            tokens.append(rng.choice(WORDS) + " ")
+    return tokens
+
+
+def jittered(value, jitter):
+    return max(0.0, value * (1 + random.uniform(-jitter, jitter)))
+
+
+def usage(messages, completion_tokens):
+    prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 3
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+def chunk(model, delta, finish_reason=None):
+    return {
+        "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+@app.get("/health")
+async def health():
+    return stats
+
+
+@app.post("/v1/chat/completions")
+async def completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    cfg = settings(model)
+    stats["requests"] += 1
+    n = min(cfg["reply_tokens"], body.get("max_tokens") or cfg["reply_tokens"])
+    await asyncio.sleep(jittered(cfg["ttft"], cfg["jitter"]))
+    if random.random() < cfg["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "fake upstream error", "type": "server_error"}}, 503)
+    tokens = reply_tokens(n)
+    delay = 1 / cfg["tokens_per_sec"] if cfg["tokens_per_sec"] > 0 else 0
+
+    if body.get("stream"):
+        stats["streams"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        async def events():
+            yield f"data: {json.dumps(chunk(model, {'role': 'assistant', 'content': ''}), ensure_ascii=False)}\n\n"
+            for token in tokens:
+                yield f"data: {json.dumps(chunk(model, {'content': token}), ensure_ascii=False)}\n\n"
+                if delay:
+                    await asyncio.sleep(delay)
+            yield f"data: {json.dumps(chunk(model, {}, 'stop'))}\n\n"
+            if include_usage:
+                last = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                        "choices": [], "usage": usage(body["messages"], n)}
+                yield f"data: {json.dumps(last)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    await asyncio.sleep(delay * n)
+    return JSONResponse({
+        "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+        "usage": usage(body["messages"], n),
+    })
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Поддельный OpenAI-совместимый апстрим")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=CONFIG["ttft"], help="секунд до первого токена")
+    parser.add_argument("--tokens-per-sec", type=float, default=CONFIG["tokens_per_sec"])
+    parser.add_argument("--reply-tokens", type=int, default=CONFIG["reply_tokens"])
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="доля ответов 503")
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"])
+    parser.add_argument("--per-model", default=json.dumps(CONFIG["per_model"]), help="JSON с настройками по моделям")
+    args = parser.parse_args()
+    CONFIG.update(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec, reply_tokens=args.reply_tokens,
+                  error_rate=args.error_rate, jitter=args.jitter, per_model=json.loads(args.per_model))
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
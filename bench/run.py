@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.dirname(os.path.abspath(__file__))
+
+PROMPTS = [
+    "Напиши полный код TODO-приложения на Python",
+    "Объясни что такое API простыми словами",
+    "Напиши игру змейку на JavaScript",
+    "Проанализируй плюсы и минусы удалённой работы",
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    # RSS процесса приложения (и его воркеров) из /proc
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def wait_ready(url, timeout=30, interval=0.2):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.monotonic() < deadline:
+            try:
+                if (await c.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(interval)
+    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+
+
+def start_servers(args, workdir):
+    upstream_port, app_port = free_port(), free_port()
+    fake_env = dict(os.environ, FAKE_TTFT=str(args.ttft), FAKE_TOKENS_PER_SEC=str(args.tokens_per_sec),
+                    FAKE_REPLY_TOKENS=str(args.reply_tokens), FAKE_ERROR_RATE=str(args.error_rate))
+    upstream = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fake_upstream:app", "--app-dir", BENCH, "--port", str(upstream_port), "--log-level", "warning"],
+        env=fake_env,
+    )
+    app_env = dict(os.environ, HF_TOKEN="bench", UPSTREAM_BASE_URL=f"http://127.0.0.1:{upstream_port}/v1",
+                   SESSION_STORE=args.store or os.path.join(workdir, "sessions.db"),
+                   # Все запросы идут с одного IP — лимит на пользователя здесь только мешает
+                   RATE_LIMIT_PER_MIN=str(args.rate_limit))
+    spawned = time.monotonic()
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--port", str(app_port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        env=app_env, cwd=workdir,
+    )
+    return upstream, app, spawned, f"http://127.0.0.1:{upstream_port}", f"http://127.0.0.1:{app_port}"
+
+
+async def send_chat(c, base, sid, stream, prompt):
+    data = {"user_message": prompt, "session_id": sid, "model_name": "Qwen3 Coder", "role_name": "Программист"}
+    if not stream:
+        r = await c.post(f"{base}/chat", data=data)
+        r.raise_for_status()
+        return None
+    started = time.perf_counter()
+    ttft = None
+    async with c.stream("POST", f"{base}/chat/stream", data=data) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if ttft is None and line.startswith("event: delta"):
+                ttft = time.perf_counter() - started
+            if line.startswith("event: error"):
+                raise RuntimeError("error event")
+    return ttft
+
+
+async def prepare_sessions(c, base, count, history, stream, concurrency):
+    # Чаты с заданной длиной истории для /chat, /continue и /export
+    sids = [str(uuid.uuid4()) for _ in range(count)]
+    sem = asyncio.Semaphore(concurrency)
+
+    async def fill(sid):
+        async with sem:
+            for turn in range(history):
+                await send_chat(c, base, sid, stream, f"{random.choice(PROMPTS)} #{turn}")
+
+    await asyncio.gather(*(fill(sid) for sid in sids))
+    return sids
+
+
+async def run_scenario(name, make_request, requests, concurrency, app_pid):
+    latencies = []
+    ttfts = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    rss_before = rss_mb(app_pid)
+
+    async def one(i):
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            try:
+                ttft = await make_request(i)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    rss_after = rss_mb(app_pid)
+    result = {
+        "scenario": name,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "rss_before_mb": round(rss_before, 1),
+        "rss_after_mb": round(rss_after, 1),
+        "rss_growth_mb": round(rss_after - rss_before, 1),
+    }
+    if ttfts:
+        result["ttft_p50_ms"] = round(percentile(ttfts, 0.5) * 1000, 1)
+        result["ttft_p95_ms"] = round(percentile(ttfts, 0.95) * 1000, 1)
+    return result
+
+
+def print_table(results):
+    columns = ["scenario", "requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "rss_after_mb", "rss_growth_mb"]
+    print(" | ".join(f"{c:>14}" for c in columns))
+    for r in results:
+        print(" | ".join(f"{str(r.get(c, '-')):>14}" for c in columns))
+
+
+async def bench(args):
+    workdir = tempfile.mkdtemp(prefix="qwen-bench-")
+    upstream, app, spawned, upstream_url, base = start_servers(args, workdir)
+    try:
+        await wait_ready(f"{upstream_url}/health")
+        # Холодный старт: от запуска процесса до первой отданной страницы
+        await wait_ready(f"{base}/", interval=0.01)
+        cold_start = time.monotonic() - spawned
+        async with httpx.AsyncClient() as c:
+            health = (await c.get(f"{base}/healthz")).json()
+        print(f"cold start → first 200: {cold_start * 1000:.0f} ms" + (f" (budget {args.startup_budget * 1000:.0f} ms)" if args.startup_budget else ""))
+        print("startup steps:", health["startup"]["steps"])
+        limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as c:
+            sids = await prepare_sessions(c, base, max(args.concurrency, 4), args.history, args.stream, args.concurrency)
+            scenarios = {
+                "home": lambda i: get_ok(c, f"{base}/"),
+                "chat": lambda i: send_chat(c, base, sids[i % len(sids)], args.stream, random.choice(PROMPTS)),
+                "continue": lambda i: get_ok(c, f"{base}/continue/{sids[i % len(sids)]}"),
+                "export": lambda i: get_ok(c, f"{base}/export/{sids[i % len(sids)]}"),
+                "load": lambda i: get_ok(c, f"{base}/chat/{sids[i % len(sids)]}"),
+            }
+            results = []
+            for name in args.scenarios.split(","):
+                results.append(await run_scenario(name, scenarios[name], args.requests, args.concurrency, app.pid))
+        print_table(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"config": vars(args), "results": results, "cold_start_ms": round(cold_start * 1000, 1), "health": health}, f, ensure_ascii=False, indent=2)
+        if args.startup_budget and cold_start > args.startup_budget:
+            raise SystemExit(f"холодный старт {cold_start:.2f} с превысил бюджет {args.startup_budget:.2f} с")
+        return results
+    finally:
+        for p in (app, upstream):
+            p.terminate()
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+async def get_ok(c, url):
+    r = await c.get(url)
+    r.raise_for_status()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест чата на поддельном апстриме")
+    parser.add_argument("--scenarios", default="home,chat,load,continue,export", help="через запятую: home,chat,load,continue,export")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--history", type=int, default=10, help="ходов в каждом чате перед замером")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="POST /chat/stream вместо /chat")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--store", default="", help="SESSION_STORE для приложения (по умолчанию — временная SQLite)")
+    parser.add_argument("--rate-limit", type=float, default=0, help="RATE_LIMIT_PER_MIN для приложения")
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tokens-per-sec", type=float, default=500)
+    parser.add_argument("--reply-tokens", type=int, default=300)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--json", default="", help="сохранить результаты в файл")
+    parser.add_argument("--startup-budget", type=float, default=0, help="бюджет холодного старта в секундах; превышение — ненулевой код выхода")
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
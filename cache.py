@@ -0,0 +1,105 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize(text):
+    # Только края и переводы строк: регистр и отступы внутри меняют смысл (код, имена)
+    return (text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
+def cache_key(model_id, messages, temperature):
+    # Системный промпт роли входит в messages, поэтому отдельно не нужен
+    payload = [model_id, round(float(temperature), 2), [(m["role"], normalize(m["content"])) for m in messages]]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class DiskTier:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+
+    def get(self, key, ttl):
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > ttl:
+                self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+        return row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO completions (key, value, created) VALUES (?, ?, ?)", (key, value, time.time()))
+
+    def purge(self, ttl):
+        with self.lock:
+            self.db.execute("DELETE FROM completions WHERE created < ?", (time.time() - ttl,))
+
+
+class CompletionCache:
+    # LRU по байтам + TTL в памяти, необязательный второй уровень на диске
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=86400, disk_path=""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk = DiskTier(disk_path) if disk_path else None
+        if self.disk is not None:
+            self.disk.purge(ttl)
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "stores": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, created, _ = entry
+            if time.time() - created <= self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value
+            self.drop(key)
+        if self.disk is not None:
+            value = self.disk.get(key, self.ttl)
+            if value is not None:
+                self.stats["disk_hits"] += 1
+                self.remember(key, value)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        if not value:
+            return
+        self.stats["stores"] += 1
+        self.remember(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def remember(self, key, value):
+        if key in self.entries:
+            self.drop(key)
+        nbytes = len(value.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (value, time.time(), nbytes)
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            old_key = next(iter(self.entries))
+            self.drop(old_key)
+            self.stats["evictions"] += 1
+
+    def drop(self, key):
+        _, _, nbytes = self.entries.pop(key)
+        self.size -= nbytes
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hit_rate = (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0
+        return dict(self.stats, entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes, hit_rate=round(hit_rate, 4))
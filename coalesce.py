@@ -0,0 +1,127 @@
+import asyncio
+import time
+from contextlib import aclosing, asynccontextmanager
+
+
+class SessionLocks:
+    # Один ход на чат за раз: второе сообщение ждёт, пока первое допишется
+    def __init__(self):
+        self.locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+
+class Flight:
+    # Одна генерация и все, кто на неё подписался; опоздавшие получают события с начала.
+    # Журнал для опоздавших держится коротким: событие-состояние (с облегчённой версией)
+    # сжимается, когда приходит следующее, а после конца compact оставляет только нужное
+    def __init__(self, linger, cancel_on_leave=True, compact=None):
+        self.linger = linger
+        self.cancel_on_leave = cancel_on_leave
+        self.compact = compact
+        self.events = []
+        self.superseded = None
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def publish(self, event, light=None):
+        # light — чем заменить это событие в журнале, когда придёт следующее с light
+        if light is not None:
+            if self.superseded is not None:
+                i, previous = self.superseded
+                self.events[i] = previous
+            self.superseded = (len(self.events), light)
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def close(self):
+        # Подписчики, которые ещё читают, держат старый список — новый нужен только опоздавшим
+        if self.compact is not None:
+            self.events = self.compact(self.events)
+        self.superseded = None
+        self.done = True
+        self.finished_at = time.monotonic()
+        self.changed.set()
+
+    async def drain(self, events):
+        async with aclosing(events):
+            async for event in events:
+                # Генерация может отдавать пару (событие, облегчённая версия для журнала)
+                if isinstance(event, tuple):
+                    self.publish(*event)
+                else:
+                    self.publish(event)
+
+    def expired(self):
+        return self.done and time.monotonic() - self.finished_at >= self.linger
+
+    async def follow(self):
+        self.subscribers += 1
+        try:
+            i = 0
+            events = self.events
+            while True:
+                while i < len(events):
+                    yield events[i]
+                    i += 1
+                if self.done:
+                    return
+                await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            # Все ушли до конца генерации — останавливаем её, как при обычном разрыве
+            if not self.subscribers and not self.done and self.cancel_on_leave:
+                self.task.cancel()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+
+    def get(self, key):
+        self.prune()
+        flight = self.flights.get(key)
+        if flight is None or flight.expired():
+            return None
+        return flight
+
+    def start(self, key, run, linger=0.0, cancel_on_leave=True, compact=None):
+        # run(flight) — корутина генерации; после конца ответ ещё linger секунд
+        # отдаётся повторным запросам с тем же ключом
+        self.prune()
+        flight = self.flights[key] = Flight(linger, cancel_on_leave, compact)
+        flight.task = asyncio.create_task(self.run(flight, run))
+        return flight
+
+    async def run(self, flight, run):
+        try:
+            return await run(flight)
+        finally:
+            flight.close()
+            # Закончившиеся полёты не ждут следующего start(): их журнал может быть большим
+            self.prune()
+            if flight.linger:
+                asyncio.get_running_loop().call_later(flight.linger, self.prune)
+
+    def prune(self):
+        for key in [k for k, f in self.flights.items() if f.expired()]:
+            del self.flights[key]
+
+    def __len__(self):
+        return sum(1 for f in self.flights.values() if not f.done)
@@ -0,0 +1,93 @@
+import io
+import json
+import re
+import zipfile
+
+RULE = "=" * 40
+SEPARATOR = "─" * 40
+
+
+def speaker(msg):
+    return "👤 Вы" if msg["role"] == "user" else "🤖 AI"
+
+
+# Каждый формат — генератор кусков по одному сообщению: транскрипт целиком не собирается
+def txt_chunks(session, sid=""):
+    yield f"=== AI Chat Export ===\nМодель: {session.get('model')}\nРоль: {session.get('role')}\n{RULE}\n\n"
+    if session.get("summaries"):
+        yield "📝 КОНТЕКСТ:\n"
+        for i, sm in enumerate(session["summaries"], 1):
+            yield f"\n--- Саммари {i} ---\n{sm}\n"
+        yield "\n" + RULE + "\n\n"
+    for msg in session["messages"]:
+        yield f"{speaker(msg)}:\n{msg['content']}\n\n{SEPARATOR}\n\n"
+
+
+def md_chunks(session, sid=""):
+    yield f"# {session.get('title', 'Новый чат')}\n\n**Модель:** {session.get('model')} · **Роль:** {session.get('role')}\n\n"
+    if session.get("continued_from"):
+        yield f"_Продолжение чата «{session['continued_from']}»_\n\n"
+    if session.get("summaries"):
+        yield "## 📝 Контекст\n\n"
+        for i, sm in enumerate(session["summaries"], 1):
+            yield f"### Саммари {i}\n\n{sm}\n\n"
+        yield "---\n\n"
+    for msg in session["messages"]:
+        yield f"### {speaker(msg)}\n\n{msg['content']}\n\n"
+
+
+def jsonl_chunks(session, sid=""):
+    meta = {"type": "chat", "id": sid, "title": session.get("title", "Новый чат"), "model": session.get("model"),
+            "role": session.get("role"), "continued_from": session.get("continued_from", "")}
+    yield json.dumps(meta, ensure_ascii=False) + "\n"
+    for i, sm in enumerate(session.get("summaries", []), 1):
+        yield json.dumps({"type": "summary", "index": i, "content": sm}, ensure_ascii=False) + "\n"
+    for msg in session["messages"]:
+        yield json.dumps({"type": "message", "role": msg["role"], "content": msg["content"]}, ensure_ascii=False) + "\n"
+
+
+FORMATS = {
+    "txt": (txt_chunks, "text/plain; charset=utf-8"),
+    "md": (md_chunks, "text/markdown; charset=utf-8"),
+    "jsonl": (jsonl_chunks, "application/x-ndjson; charset=utf-8"),
+}
+
+
+def archive_name(sid, session, fmt):
+    title = re.sub(r"[^\w\- ]+", "", session.get("title", "")).strip()[:40] or "chat"
+    return f"{title}_{sid[:8]}.{fmt}"
+
+
+class ZipSink(io.RawIOBase):
+    # Поток без seek: zipfile пишет дескрипторы данных после каждого файла,
+    # а мы забираем готовые байты сразу, не дожидаясь конца архива
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_chunks(chats, fmt):
+    # chats — итератор (sid, session); в памяти только текущее сообщение и буфер deflate
+    render = FORMATS[fmt][0]
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for sid, session in chats:
+            with zf.open(archive_name(sid, session, fmt), "w") as entry:
+                for chunk in render(session, sid):
+                    entry.write(chunk.encode("utf-8"))
+                    if sink.chunks:
+                        yield sink.drain()
+            if sink.chunks:
+                yield sink.drain()
+    yield sink.drain()
@@ -1,16 +1,91 @@
+import time
+# Отсчёт холодного старта: импорты ниже — заметная его часть
+IMPORT_STARTED = time.perf_counter()
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
-from openai import OpenAI
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response
+from contextlib import aclosing, asynccontextmanager, nullcontext
 import os
+import sys
+import logging
 import uuid
-import markdown
+import json
+import gzip
+import hashlib
+import asyncio
+import anyio
+from collections import OrderedDict
+from store import open_store
+from messages import Message
+from memory import ChunkStore, MemoryStore, chunk_turns, load_numpy, memory_range, reserve_chunks
+from mdrender import IncrementalRenderer, md_to_html, render_many, render_markdown
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from cache import CompletionCache, cache_key
+from metrics import LLM_TOKENS, PROMPT_PREFIX_TOKENS, STARTUP, UPSTREAM_ERRORS, UPSTREAM_SECONDS, UPSTREAM_TTFT, MetricsMiddleware, Trace, registry
+from routing import Router
+from admission import FairScheduler, Overloaded, RateLimiter
+from coalesce import SessionLocks, SingleFlight
+from export import FORMATS as EXPORT_FORMATS, zip_chunks
+from batch import BatchError, BatchStore, bounded_map, jsonl_line, parse_jsonl
+from tokens import count_tokens, count_history_tokens, message_tokens
+STARTUP.add("imports", time.perf_counter() - IMPORT_STARTED)
 
-app = FastAPI()
 
-client = OpenAI(
-    base_url="https://router.huggingface.co/v1",
-    api_key=os.environ.get("HF_TOKEN", ""),
-)
+@asynccontextmanager
+async def lifespan(app):
+    # Готовность для /healthz; при остановке закрываем пул соединений с апстримом
+    STARTUP.mark("ready")
+    yield
+    if client is not None:
+        await client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+logger = logging.getLogger("qwen-chat")
+
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "32"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "16"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "16"))
+UPSTREAM_CONNECT_TIMEOUT = 10.0
+UPSTREAM_DEFAULT_TIMEOUT = 120.0
+
+# 1 — openai/httpx, markdown и numpy грузятся при первом обращении, а не до первой страницы;
+# 0 — всё загружается при импорте, как раньше
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "1") == "1"
+
+client = None
+
+
+def upstream_client():
+    # openai вместе с httpx — больше половины времени импорта приложения
+    global client
+    if client is None:
+        with STARTUP.step("upstream_client"):
+            import httpx
+            from openai import AsyncOpenAI
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(UPSTREAM_DEFAULT_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            )
+            client = AsyncOpenAI(
+                base_url=os.environ.get("UPSTREAM_BASE_URL", "https://router.huggingface.co/v1"),
+                api_key=os.environ.get("HF_TOKEN", ""),
+                http_client=http_client,
+                # Повторы делает роутер — через фолбэк на другую модель
+                max_retries=0,
+            )
+    return client
+
+# Ограничение одновременных запросов к апстриму на воркер
+upstream_semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
 
 MODELS = {
     "Qwen3 Coder": "Qwen/Qwen3-Coder-Next:novita",
@@ -32,99 +107,582 @@ ROLES = {
     "Аналитик": "Ты аналитик. Разбирай информацию, делай выводы. Отвечай на русском.",
 }
 
+# Таймауты на чтение ответа (сек) — reasoning-модели думают дольше
+MODEL_TIMEOUTS = {
+    "deepseek-ai/DeepSeek-R1": 300.0,
+    "Qwen/Qwen3-235B-A22B": 180.0,
+    "meta-llama/Llama-3.3-70B-Instruct": 150.0,
+}
+
+# Куда переключаться, если модель не отвечает (можно переопределить JSON в MODEL_FALLBACKS)
+MODEL_FALLBACKS = {
+    "Qwen3 Coder": ["Qwen3 235B", "Llama 3.3 70B"],
+    "Qwen3 235B": ["Qwen3 Coder", "Llama 3.3 70B"],
+    "DeepSeek R1": ["Qwen3 235B", "Llama 3.3 70B"],
+    "Llama 3.3 70B": ["Qwen3 235B", "Mistral Small"],
+    "Gemma 3 27B": ["Mistral Small", "Llama 3.3 70B"],
+    "Phi-4": ["Mistral Small", "Gemma 3 27B"],
+    "Mistral Small": ["Gemma 3 27B", "Phi-4"],
+}
+if os.environ.get("MODEL_FALLBACKS"):
+    MODEL_FALLBACKS = json.loads(os.environ["MODEL_FALLBACKS"])
+
+# Хедж: если модель молчит дольше своего p95, параллельно спрашиваем следующую
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "") == "1"
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "2"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "10"))
+
+# Допуск к моделям: ведро токенов на пользователя и справедливая очередь между пользователями
+RATE_LIMIT_PER_MIN = float(os.environ.get("RATE_LIMIT_PER_MIN", "20"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_KEY = os.environ.get("RATE_LIMIT_KEY", "ip")
+# Сколько своих прокси стоит перед приложением: каждый дописывает адрес справа в X-Forwarded-For,
+# левые записи присылает сам клиент и им верить нельзя. 0 — заголовок не читается
+TRUST_PROXY_HOPS = int(os.environ.get("TRUST_PROXY_HOPS", "1"))
+ADMISSION_CONCURRENCY = int(os.environ.get("ADMISSION_CONCURRENCY", str(UPSTREAM_CONCURRENCY)))
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", "64"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "30"))
+
+# Сколько «стоит» запрос в очереди: медленные модели занимают слот дольше
+MODEL_COSTS = {
+    "deepseek-ai/DeepSeek-R1": 3.0,
+    "Qwen/Qwen3-235B-A22B": 2.0,
+    "meta-llama/Llama-3.3-70B-Instruct": 1.5,
+}
+
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MIN, RATE_LIMIT_BURST)
+scheduler = FairScheduler(ADMISSION_CONCURRENCY, ADMISSION_QUEUE, ADMISSION_MAX_WAIT)
+
+router = Router(
+    {MODELS[name]: [MODELS[f] for f in chain if f in MODELS] for name, chain in MODEL_FALLBACKS.items() if name in MODELS},
+    hedge=HEDGE_REQUESTS,
+    hedge_min_delay=HEDGE_MIN_DELAY,
+    hedge_default_delay=HEDGE_DEFAULT_DELAY,
+)
+
 MAX_TOKENS_RESPONSE = 16384
 MAX_MESSAGES_BEFORE_COMPRESS = 20
 MAX_CONTEXT_TOKENS = 28000
+MAX_SUMMARIES = 4
+PAGE_MESSAGES = 40
+# stable — саммари отдельными блоками и сдвиг окна истории блоками (префикс промпта кэшируется у провайдера);
+# legacy — одно склеенное саммари и посообщенная обрезка
+PROMPT_LAYOUT = os.environ.get("PROMPT_LAYOUT", "stable")
+HISTORY_TRIM_CHUNK = int(os.environ.get("HISTORY_TRIM_CHUNK", "8"))
+# retrieval — сжатые сообщения попадают в поисковую память чата, в промпт идут только
+# последние саммари и top-k подходящих кусков; summaries — все саммари в промпте, как раньше
+MEMORY_MODE = os.environ.get("MEMORY_MODE", "retrieval")
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "4"))
+MEMORY_RECENT_SUMMARIES = 1
+CHAT_LIST_PAGE = 20
+SUMMARY_ROLLUP_FANIN = 3
+COMPRESSION_CONCURRENCY = int(os.environ.get("COMPRESSION_CONCURRENCY", "2"))
+
+CONTINUE_PROMPT = "Сделай подробное краткое содержание. Сохрани ВСЕ детали. Пиши на русском."
+# Короткий несжатый хвост переносится в новый чат как есть, без запроса к модели
+CONTINUE_RAW_TAIL_TOKENS = 1500
+CONTINUE_MEMORY_WAIT = 30.0
+SUMMARY_PROMPT = "Сделай краткое содержание диалога. Сохрани ВСЕ важные детали: код, решения, факты. Пиши на русском."
+ROLLUP_PROMPT = "Объедини эти краткие содержания разговора в одно. Сохрани ВСЕ важные детали: код, решения, факты. Пиши на русском."
+
+SESSION_STORE_URL = os.environ.get("SESSION_STORE", "sessions.db")
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "512"))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "900"))
+SESSION_CACHE_MB = int(os.environ.get("SESSION_CACHE_MB", "256"))
+SESSION_MAX_MB = int(os.environ.get("SESSION_MAX_MB", "16"))
 
-chat_sessions = {}
+with STARTUP.step("session_store"):
+    sessions = open_store(
+        SESSION_STORE_URL,
+        max_hot=SESSION_CACHE_SIZE,
+        ttl=SESSION_CACHE_TTL,
+        max_bytes=SESSION_CACHE_MB * 1024 * 1024,
+        max_session_bytes=SESSION_MAX_MB * 1024 * 1024,
+    )
+memory_store = MemoryStore(ChunkStore(":memory:" if SESSION_STORE_URL in ("", "memory", ":memory:") else SESSION_STORE_URL.removeprefix("sqlite:///")))
 token_counter = {"total": 0}
 
+# Кэш ответов на одинаковые запросы (включается явно)
+COMPLETION_CACHE = os.environ.get("COMPLETION_CACHE", "") == "1"
+COMPLETION_CACHE_MB = int(os.environ.get("COMPLETION_CACHE_MB", "64"))
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", "86400"))
+COMPLETION_CACHE_DISK = os.environ.get("COMPLETION_CACHE_DISK", "")
+CACHE_REPLAY_CHUNK = 48
+# Пакетные задачи: JSONL с запросами, результаты хранятся для продолжения по id задачи
+BATCH_STORE = os.environ.get("BATCH_STORE", "batches.db")
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+BATCH_TTL = float(os.environ.get("BATCH_TTL", str(7 * 86400)))
+BATCH_TEMPERATURE = 0.3
+# Как часто во время генерации отправлять отрендеренный markdown (сек)
+STREAM_RENDER_INTERVAL = 0.3
 
-def estimate_tokens(text):
-    if not text:
-        return 0
-    return int(len(text) * 0.33)
+completion_cache = CompletionCache(COMPLETION_CACHE_MB * 1024 * 1024, COMPLETION_CACHE_TTL, COMPLETION_CACHE_DISK) if COMPLETION_CACHE else None
+batch_store = BatchStore(":memory:" if BATCH_STORE in ("", "memory", ":memory:") else BATCH_STORE.removeprefix("sqlite:///"))
+batch_store.purge(BATCH_TTL)
 
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_TYPES = {".css": "text/css; charset=utf-8", ".js": "application/javascript; charset=utf-8"}
 
-def count_history_tokens(messages):
-    total = 0
-    for msg in messages:
-        total += estimate_tokens(msg.get("content", ""))
-    return total
+# Идущие ходы чатов: повторная отправка того же сообщения подключается к уже идущему ответу
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "300"))
+turns = SingleFlight()
+session_locks = SessionLocks()
+batch_jobs = SingleFlight()
 
+compression_jobs = {}
+compression_semaphore = asyncio.Semaphore(COMPRESSION_CONCURRENCY)
+# Продолжения, чья память ещё суммаризируется, и готовые саммари хвостов для повторного продолжения
+continuation_jobs = {}
+tail_summaries = OrderedDict()
+TAIL_SUMMARIES_MAX = 256
 
-def md_to_html(text):
-    if not text:
-        return ""
-    return markdown.markdown(text, extensions=['fenced_code', 'tables', 'nl2br'])
+registry.gauge("upstream_in_flight", "Запросов к моделям в работе", lambda: UPSTREAM_CONCURRENCY - upstream_semaphore._value)
+registry.gauge("admission_queue_depth", "Запросов в очереди к моделям", lambda: scheduler.depth())
+registry.gauge("admission_active", "Запросов, получивших слот", lambda: scheduler.active)
+registry.gauge("turns_in_flight", "Генерируемых ответов", lambda: len(turns))
+registry.gauge("compression_jobs", "Фоновых задач сжатия истории", lambda: len(compression_jobs))
+registry.gauge("batch_jobs", "Выполняемых пакетных задач", lambda: len(batch_jobs))
+registry.gauge("continuation_jobs", "Продолжений чатов, ждущих саммари", lambda: len(continuation_jobs))
+registry.gauge("session_cache_entries", "Чатов в горячем кэше", lambda: len(sessions.hot))
+registry.gauge("session_cache_bytes", "Примерный объём горячего кэша чатов", lambda: sessions.hot_bytes)
+registry.gauge("startup_seconds", "Длительность этапов холодного старта", lambda: {(k,): v for k, v in STARTUP.steps.items()}, ("step",))
+registry.gauge("tokens_total", "Счётчик токенов на странице", lambda: token_counter["total"])
+if completion_cache is not None:
+    registry.gauge("completion_cache", "Статистика кэша ответов", lambda: {(k,): v for k, v in completion_cache.info().items()}, ("stat",))
 
 
-def compress_history(session, model_id):
-    history = session["messages"]
-    if len(history) < MAX_MESSAGES_BEFORE_COMPRESS:
+def load_static_assets():
+    # CSS/JS читаются один раз, сжимаются заранее и отдаются по имени с хешем
+    assets = {}
+    urls = {}
+    for name in sorted(os.listdir(STATIC_DIR)):
+        base, ext = os.path.splitext(name)
+        if ext not in STATIC_TYPES:
+            continue
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()[:12]
+        variants = {"identity": raw, "gzip": gzip.compress(raw, 9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(raw, quality=11)
+        hashed = f"{base}.{digest}{ext}"
+        assets[hashed] = (STATIC_TYPES[ext], digest, variants)
+        urls[name] = f"/static/{hashed}"
+    return assets, urls
+
+
+with STARTUP.step("static_assets"):
+    STATIC_ASSETS, STATIC_URLS = load_static_assets()
+
+
+def static_url(name):
+    return STATIC_URLS[name]
+
+
+def model_timeout(model_id):
+    import httpx
+    return httpx.Timeout(MODEL_TIMEOUTS.get(model_id, UPSTREAM_DEFAULT_TIMEOUT), connect=UPSTREAM_CONNECT_TIMEOUT)
+
+
+async def request_completion(model_id, messages, max_tokens, temperature):
+    async with upstream_semaphore:
+        return await upstream_client().chat.completions.create(
+            model=model_id,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=model_timeout(model_id),
+        )
+
+
+async def stream_tokens(model_id, messages, max_tokens, temperature, info):
+    async with upstream_semaphore:
+        stream = await upstream_client().chat.completions.create(
+            model=model_id,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=model_timeout(model_id),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    info["usage"] = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Клиент мог отключиться — закрываем апстрим даже при отмене
+            with anyio.CancelScope(shield=True):
+                await stream.close()
+
+
+async def attempt_completion(model_id, messages, max_tokens, temperature):
+    try:
+        return await request_completion(model_id, messages, max_tokens, temperature)
+    except Exception:
+        UPSTREAM_ERRORS.inc(model_id)
+        raise
+
+
+async def create_completion(model_id, messages, max_tokens, temperature, info=None):
+    model_used, response, elapsed = await router.race(
+        model_id, lambda m: attempt_completion(m, messages, max_tokens, temperature), streaming=False
+    )
+    router.model(model_used).record_success(elapsed)
+    UPSTREAM_TTFT.observe(elapsed, model_used)
+    UPSTREAM_SECONDS.observe(elapsed, model_used)
+    if info is not None:
+        info["model_id"] = model_used
+        info["usage"] = response.usage
+        info["ttft"] = elapsed
+    return response
+
+
+async def first_delta(model_id, messages, max_tokens, temperature):
+    # Модель считается ответившей, когда пришёл первый токен
+    info = {}
+    deltas = stream_tokens(model_id, messages, max_tokens, temperature, info)
+    try:
+        first = await deltas.__anext__()
+    except StopAsyncIteration:
+        first = ""
+    except BaseException as e:
+        if isinstance(e, Exception):
+            UPSTREAM_ERRORS.inc(model_id)
+        with anyio.CancelScope(shield=True):
+            await deltas.aclose()
+        raise
+    return deltas, first, info
+
+
+async def discard_stream(result):
+    await result[0].aclose()
+
+
+async def stream_completion(model_id, messages, max_tokens, temperature, info=None):
+    model_used, (deltas, first, stream_info), ttft = await router.race(
+        model_id, lambda m: first_delta(m, messages, max_tokens, temperature), streaming=True, discard=discard_stream
+    )
+    UPSTREAM_TTFT.observe(ttft, model_used)
+    if info is not None:
+        info["model_id"] = model_used
+        info["ttft"] = ttft
+    started = time.monotonic() - ttft
+    try:
+        async with aclosing(deltas):
+            try:
+                if first:
+                    yield first
+                async for delta in deltas:
+                    yield delta
+            except Exception:
+                router.model(model_used).record_failure()
+                UPSTREAM_ERRORS.inc(model_used)
+                raise
+        elapsed = time.monotonic() - started
+        router.model(model_used).record_success(elapsed, ttft)
+        UPSTREAM_SECONDS.observe(elapsed, model_used)
+    finally:
+        # Клиент ушёл посреди потока — исхода нет, но пробный запрос полуоткрытой модели закончен
+        router.model(model_used).end()
+    if info is not None:
+        info["usage"] = stream_info.get("usage")
+
+
+def lookup_cache(model_id, messages, temperature, no_cache=False):
+    # При no_cache кэш не читается, но ответ в него запишется
+    if completion_cache is None or no_cache:
+        return None
+    return completion_cache.get(cache_key(model_id, messages, temperature))
+
+
+def store_cache(info, messages, temperature, reply):
+    # Ключ — по модели, которая ответила на самом деле: ответ запасной модели или
+    # выигравшего хеджа не должен потом выдаваться за ответ запрошенной
+    if completion_cache is not None:
+        completion_cache.put(cache_key(info["model_id"], messages, temperature), reply)
+
+
+async def replay_reply(text):
+    # Кэшированный ответ отдаётся так же кусками, как живой поток
+    for i in range(0, len(text), CACHE_REPLAY_CHUNK):
+        yield text[i:i + CACHE_REPLAY_CHUNK]
+        await asyncio.sleep(0)
+
+
+async def admitted_stream(user, model_id, trace, deltas):
+    async with upstream_slot(user, model_id, trace):
+        async with aclosing(deltas):
+            async for delta in deltas:
+                yield delta
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def dialog_text(messages):
+    return "".join(f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}\n\n" for msg in messages)
+
+
+async def summarize(model_id, prompt, text, max_tokens):
+    response = await create_completion(
+        model_id,
+        [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": text}
+        ],
+        max_tokens=max_tokens,
+        temperature=0.3,
+    )
+    return response.choices[0].message.content
+
+
+def remember_dropped(session, dropped, pending):
+    # Внутри sessions.update: под уходящие из окна сообщения занимаются номера кусков,
+    # а тексты пишутся уже после того, как сессия записалась
+    if MEMORY_MODE != "retrieval" or not dropped:
+        return
+    chunks = chunk_turns(dropped)
+    pending["start"] = reserve_chunks(session, chunks)
+    pending["chunks"] = chunks
+
+
+async def compress_history(session_id, model_id):
+    session = sessions.get(session_id)
+    if session is None or len(session["messages"]) < MAX_MESSAGES_BEFORE_COMPRESS:
         return
+    # В messages лежат только ещё не сжатые сообщения — их и отправляем
+    history = session["messages"]
     split_point = len(history) * 2 // 3
     old_messages = history[:split_point]
-    recent_messages = history[split_point:]
-    old_text = ""
-    for msg in old_messages:
-        role = "User" if msg["role"] == "user" else "Assistant"
-        old_text += f"{role}: {msg['content']}\n\n"
     try:
-        summary_response = client.chat.completions.create(
-            model=model_id,
-            messages=[
-                {"role": "system", "content": "Сделай краткое содержание диалога. Сохрани ВСЕ важные детали: код, решения, факты. Пиши на русском."},
-                {"role": "user", "content": f"Диалог:\n\n{old_text}"}
-            ],
-            max_tokens=2000,
-            temperature=0.3,
-        )
-        summary = summary_response.choices[0].message.content
-        if "summaries" not in session:
-            session["summaries"] = []
-        session["summaries"].append(summary)
-        session["messages"] = recent_messages
-    except:
-        session["messages"] = history[-MAX_MESSAGES_BEFORE_COMPRESS:]
+        summary = await summarize(model_id, SUMMARY_PROMPT, f"Диалог:\n\n{dialog_text(old_messages)}", 2000)
+    except Exception:
+        summary = None
+    # Пока шло сжатие, в чат могли дописать, очистить или удалить его;
+    # идущий ход дописывается целиком до того, как мы заменим историю
+    pending = {}
+
+    def apply(session):
+        if session is None or [(m["role"], m["content"]) for m in session["messages"][:split_point]] != [(m["role"], m["content"]) for m in old_messages]:
+            return None
+        if summary is None:
+            remember_dropped(session, session["messages"][:-MAX_MESSAGES_BEFORE_COMPRESS], pending)
+            session["messages"] = session["messages"][-MAX_MESSAGES_BEFORE_COMPRESS:]
+            return session
+        remember_dropped(session, session["messages"][:split_point], pending)
+        session.setdefault("summaries", []).append(summary)
+        session["messages"] = session["messages"][split_point:]
+        return session
+
+    async with session_locks.hold(session_id):
+        applied = sessions.update(session_id, apply)
+        if applied is not None and pending:
+            memory_store.remember(session_id, pending["start"], pending["chunks"], memory_range(applied)[0])
+    if summary is None or applied is None:
+        return
+    await rollup_summaries(session_id, model_id)
+
+
+async def rollup_summaries(session_id, model_id):
+    # Старые саммари сворачиваются в одно, чтобы их число не росло бесконечно
+    while True:
+        session = sessions.get(session_id)
+        if session is None or len(session.get("summaries", [])) <= MAX_SUMMARIES:
+            return
+        oldest = session["summaries"][:SUMMARY_ROLLUP_FANIN]
+        try:
+            merged = await summarize(model_id, ROLLUP_PROMPT, "\n\n---\n\n".join(oldest), 2000)
+        except Exception:
+            return
+
+        def apply(session):
+            if session is None or session.get("summaries", [])[:SUMMARY_ROLLUP_FANIN] != oldest:
+                return None
+            session["summaries"] = [merged] + session["summaries"][SUMMARY_ROLLUP_FANIN:]
+            return session
+
+        async with session_locks.hold(session_id):
+            if sessions.update(session_id, apply) is None:
+                return
+
+
+async def run_compression(session_id, model_id):
+    try:
+        async with compression_semaphore:
+            with Trace().span("compress_history"):
+                await compress_history(session_id, model_id)
+    except Exception:
+        logger.exception("history compression failed for %s", session_id)
+
+
+def schedule_compression(session_id, session, model_id):
+    # Сжатие идёт в фоне после ответа; на один чат — не больше одной задачи
+    if len(session["messages"]) < MAX_MESSAGES_BEFORE_COMPRESS or session_id in compression_jobs:
+        return
+    task = asyncio.create_task(run_compression(session_id, model_id))
+    compression_jobs[session_id] = task
+    task.add_done_callback(lambda _: compression_jobs.pop(session_id, None))
+
+
+def tail_key(messages):
+    return hashlib.blake2b(dialog_text(messages).encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def summarize_tail(user, new_sid, model_id, tail, key, position, delay=0):
+    # Суммаризируется только несжатый хвост старого чата; прежние саммари уже в новом чате
+    try:
+        # Очередь была переполнена при открытии чата — ждём, сколько она просила
+        await asyncio.sleep(delay)
+        async with upstream_slot(user, model_id):
+            with Trace().span("continue_summary"):
+                summary = await summarize(model_id, CONTINUE_PROMPT, f"Диалог:\n\n{dialog_text(tail)}", 3000)
+        tail_summaries[key] = summary
+        while len(tail_summaries) > TAIL_SUMMARIES_MAX:
+            tail_summaries.popitem(last=False)
+    except Exception:
+        logger.exception("continuation summary failed for %s", new_sid)
+        summary = dialog_text(tail)[:3000]
+    def apply(session):
+        # Новый чат могли очистить или удалить, пока шла суммаризация
+        if session is None or not session.get("memory_pending"):
+            return None
+        session["summaries"].insert(position, summary)
+        del session["memory_pending"]
+        return session
+
+    async with session_locks.hold(new_sid):
+        if sessions.update(new_sid, apply) is None:
+            return
+    await rollup_summaries(new_sid, model_id)
+
+
+def schedule_continuation(user, session_id, session, delay=0):
+    # Всё для суммаризации хвоста лежит в memory_pending самой сессии: задача живёт только
+    # в этом процессе, и после рестарта или на другом воркере её можно запустить заново
+    pending = session.get("memory_pending") if session is not None else None
+    if not pending or session_id in continuation_jobs:
+        return
+    model_id = MODELS.get(session.get("model"), MODELS["Qwen3 Coder"])
+    task = asyncio.create_task(summarize_tail(user, session_id, model_id, pending["tail"], pending["key"], pending["position"], delay))
+    continuation_jobs[session_id] = task
+    task.add_done_callback(lambda _: continuation_jobs.pop(session_id, None))
+
 
+async def memory_ready(user, session_id):
+    # Первое сообщение в продолжении ждёт память старого чата, но не дольше CONTINUE_MEMORY_WAIT
+    schedule_continuation(user, session_id, sessions.get(session_id))
+    task = continuation_jobs.get(session_id)
+    if task is not None:
+        await asyncio.wait({task}, timeout=CONTINUE_MEMORY_WAIT)
 
-def build_api_messages(session, role_name):
+
+async def recall_memory(session, session_id):
+    # Куски прошлого разговора, похожие на последнее сообщение пользователя
+    if MEMORY_MODE != "retrieval" or not session["messages"]:
+        return []
+    return await memory_store.recall(session_id, session, session["messages"][-1]["content"], MEMORY_TOP_K)
+
+
+def has_memory(session):
+    start, end = memory_range(session)
+    return MEMORY_MODE == "retrieval" and start < end
+
+
+def build_api_messages(session, role_name, model_id=None, info=None, recalled=()):
     system_prompt = ROLES.get(role_name, ROLES["Ассистент"])
     messages = [{"role": "system", "content": system_prompt}]
-    if session.get("summaries"):
-        all_summaries = "\n\n---\n\n".join(session["summaries"])
-        messages.append({"role": "system", "content": f"Контекст прошлого разговора:\n\n{all_summaries}"})
-    for msg in session["messages"]:
+    summaries = session.get("summaries", [])
+    if has_memory(session):
+        # Старые подробности достаются из памяти по запросу, целиком идут только последние саммари
+        summaries = summaries[-MEMORY_RECENT_SUMMARIES:]
+    if summaries:
+        if PROMPT_LAYOUT == "stable":
+            # Каждое саммари — отдельный неизменный блок: новое дописывается в конец, не сдвигая прежние
+            for i, summary in enumerate(summaries, 1):
+                messages.append({"role": "system", "content": f"Контекст прошлого разговора, часть {i}:\n\n{summary}"})
+        else:
+            all_summaries = "\n\n---\n\n".join(summaries)
+            messages.append({"role": "system", "content": f"Контекст прошлого разговора:\n\n{all_summaries}"})
+    system_counts = [message_tokens(msg, model_id) for msg in messages]
+    memory_msg = None
+    if recalled:
+        memory_msg = {"role": "system", "content": "Фрагменты прошлого разговора, которые могут пригодиться:\n\n" + "\n\n---\n\n".join(recalled)}
+    memory_count = message_tokens(memory_msg, model_id) if memory_msg else 0
+    budget = MAX_CONTEXT_TOKENS - sum(system_counts) - memory_count
+    # Отбрасываем самые старые сообщения по бегущей сумме, последнее остаётся всегда.
+    # В режиме stable начало окна двигается только блоками по HISTORY_TRIM_CHUNK,
+    # чтобы между сдвигами префикс промпта не менялся и провайдер брал его из кэша
+    chunk = HISTORY_TRIM_CHUNK if PROMPT_LAYOUT == "stable" else 1
+    history = session["messages"]
+    counts = [message_tokens(msg, model_id) for msg in history]
+    total = sum(counts)
+    start = 0
+    while start < len(history) - 1 and total > budget:
+        step = min(chunk - start % chunk, len(history) - 1 - start)
+        total -= sum(counts[start:start + step])
+        start += step
+    if 0 < start < len(history) - 1 and history[start]["role"] == "assistant":
+        start += 1
+    for msg in history[start:]:
         messages.append({"role": msg["role"], "content": msg["content"]})
-    total_tokens = count_history_tokens(messages)
-    while total_tokens > MAX_CONTEXT_TOKENS and len(messages) > 3:
-        messages.pop(2)
-        total_tokens = count_history_tokens(messages)
+    counts = system_counts + counts[start:]
+    if memory_msg is not None:
+        # Вспомненное ставится перед последним сообщением: префикс истории не меняется
+        messages.insert(len(messages) - 1, memory_msg)
+        counts.insert(len(counts) - 1, memory_count)
+    if info is not None:
+        info["prompt_counts"] = counts
+        info["memory_chunks"] = len(recalled)
     return messages
 
 
-def get_chat_list():
+def prompt_fingerprint(messages):
+    return [hashlib.blake2b(f"{m['role']}\0{m['content']}".encode("utf-8"), digest_size=8).hexdigest() for m in messages]
+
+
+def track_prompt_prefix(session, api_messages, info):
+    # Сколько токенов в начале промпта совпало с прошлым ходом — эту часть провайдер может взять из кэша
+    fingerprint = prompt_fingerprint(api_messages)
+    counts = info["prompt_counts"]
+    reused = 0
+    for i, (old, new) in enumerate(zip(session.get("prompt_prefix", []), fingerprint)):
+        if old != new:
+            break
+        reused += counts[i]
+    # Запишет finish_turn внутри sessions.update — этот объект сессии мог уже устареть
+    info["prompt_prefix"] = fingerprint
+    info["prompt"] = {"tokens": sum(counts), "reused": reused}
+    PROMPT_PREFIX_TOKENS.inc("total", amount=sum(counts))
+    PROMPT_PREFIX_TOKENS.inc("reused", amount=reused)
+
+
+def get_chat_list(before=None, prefix=""):
     chats = []
-    for sid, session in chat_sessions.items():
-        if session.get("messages") or session.get("summaries"):
-            title = session.get("title", "Новый чат")
-            if session.get("continued_from"):
-                title = "🔄 " + title
-            chats.append({
-                "id": sid,
-                "title": title,
-                "msg_count": len(session.get("messages", [])),
-                "has_memory": bool(session.get("summaries")),
-            })
-    return chats[-20:]
+    page = sessions.recent(CHAT_LIST_PAGE, before, prefix)
+    for meta in page:
+        title = meta["title"]
+        if meta["continued_from"]:
+            title = "🔄 " + title
+        chats.append({
+            "id": meta["id"],
+            "title": title,
+            "msg_count": meta["msg_count"],
+            "has_memory": meta["has_memory"],
+        })
+    next_cursor = page[-1]["version"] if len(page) == CHAT_LIST_PAGE else None
+    return chats, next_cursor
 
 
 def get_context_info(session_id):
-    if session_id not in chat_sessions:
-        return {"messages": 0, "tokens": 0, "compressed": False, "percent": 0, "summaries_count": 0}
-    session = chat_sessions[session_id]
-    tokens = count_history_tokens(session.get("messages", []))
+    session = sessions.get(session_id)
+    if session is None:
+        return {"messages": 0, "tokens": 0, "compressed": False, "percent": 0, "summaries_count": 0, "memory_pending": False}
+    tokens = count_history_tokens(session.get("messages", []), MODELS.get(session.get("model")))
     percent = min(100, int(tokens / MAX_CONTEXT_TOKENS * 100))
     return {
         "messages": len(session.get("messages", [])),
@@ -132,32 +690,19 @@ def get_context_info(session_id):
         "compressed": bool(session.get("summaries")),
         "percent": percent,
         "summaries_count": len(session.get("summaries", [])),
+        "memory_pending": bool(session.get("memory_pending")),
     }
 
 
-def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_role="Ассистент", current_chat_id="", continued_from=""):
-    ctx = get_context_info(session_id)
-    chat_list = get_chat_list()
-
-    # Генерируем опции моделей
-    model_options = ""
-    for name in MODELS:
-        sel = "selected" if name == selected_model else ""
-        model_options += f'<option value="{name}" {sel}>{name}</option>'
-
-    # Генерируем опции ролей
-    role_options = ""
-    for name in ROLES:
-        sel = "selected" if name == selected_role else ""
-        role_options += f'<option value="{name}" {sel}>{name}</option>'
-
-    # Генерируем список чатов
+def render_chat_list(current_chat_id="", before=None, prefix=""):
+    chat_list, next_cursor = get_chat_list(before, prefix)
+    if not chat_list:
+        return '<p class="no-chats">Пока нет чатов</p>' if before is None else ""
     chat_list_html = ""
-    if chat_list:
-        for chat in chat_list:
-            active = "active" if current_chat_id == chat["id"] else ""
-            memory = "🧠 " if chat.get("has_memory") else ""
-            chat_list_html += f'''
+    for chat in chat_list:
+        active = "active" if current_chat_id == chat["id"] else ""
+        memory = "🧠 " if chat.get("has_memory") else ""
+        chat_list_html += f'''
             <div class="chat-item-wrapper">
                 <a href="/chat/{chat["id"]}" class="chat-item {active}">
                     <span class="chat-title">{memory}{chat["title"]}</span>
@@ -168,22 +713,27 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
                     <a href="/delete/{chat["id"]}" class="delete-btn" title="Удалить" onclick="return confirm('Удалить?')">🗑️</a>
                 </div>
             </div>'''
-    else:
-        chat_list_html = '<p class="no-chats">Пока нет чатов</p>'
+    if next_cursor is not None:
+        chat_list_html += f'<button class="load-more-chats" onclick="moreChats(this)" data-before="{next_cursor}">Ещё чаты</button>'
+    return chat_list_html
 
-    # Генерируем сообщения
+
+async def render_messages(messages):
+    # Markdown рендерится вне цикла событий: после рестарта или вытеснения из кэша
+    # длинные ответы иначе блокировали бы воркер на секунды
+    htmls = iter(await render_many([msg["content"] for msg in messages if msg["role"] == "assistant" and not msg.get("error")]))
     messages_html = ""
-    if messages:
-        for msg in messages:
-            if msg["role"] == "user":
-                messages_html += f'''
+    for msg in messages:
+        if msg["role"] == "user":
+            messages_html += f'''
                 <div class="message user-msg">
                     <div class="avatar">👤</div>
                     <div class="bubble">{msg["content"]}</div>
                 </div>'''
-            elif msg["role"] == "assistant":
-                html_content = msg.get("html", msg["content"])
-                messages_html += f'''
+        elif msg["role"] == "assistant":
+            # HTML не хранится в сообщении — берётся из ограниченного кэша рендера
+            html_content = error_html(msg["content"]) if msg.get("error") else next(htmls)
+            messages_html += f'''
                 <div class="message bot-msg">
                     <div class="avatar">🤖</div>
                     <div class="bubble">
@@ -191,9 +741,12 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
                         <button class="copy-btn" onclick="copyMessage(this)" title="Скопировать">📋</button>
                     </div>
                 </div>'''
-    else:
-        if continued_from:
-            messages_html = f'''
+    return messages_html
+
+
+def render_welcome(continued_from=""):
+    if continued_from:
+        return '''
             <div class="welcome">
                 <h2>🔄 Продолжаем!</h2>
                 <p>Я помню наш прошлый разговор. Можешь продолжать!</p>
@@ -202,8 +755,7 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
                     <button onclick="fillQuestion('Продолжи писать код')">💻 Продолжи код</button>
                 </div>
             </div>'''
-        else:
-            messages_html = '''
+    return '''
             <div class="welcome">
                 <h2>👋 Привет!</h2>
                 <p>Выбери модель и роль, затем задай вопрос!</p>
@@ -217,24 +769,32 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
                 </div>
             </div>'''
 
-    # Контекст-бар
-    context_html = ""
-    if ctx:
-        warning_html = ""
-        if ctx["percent"] > 70:
-            warning_html = f'''
+
+def render_load_earlier(before):
+    if before <= 0:
+        return ""
+    return f'<button class="load-earlier" onclick="loadEarlier(this)" data-before="{before}">⬆️ Показать ранние сообщения ({before})</button>'
+
+
+def render_context_bar(session_id, continued_from=""):
+    ctx = get_context_info(session_id)
+    warning_html = ""
+    if ctx["percent"] > 70:
+        warning_html = f'''
             <div class="context-warning">
                 ⚠️ Контекст заполняется.
                 <a href="/continue/{session_id}">Продолжить в новом чате с памятью →</a>
             </div>'''
-        memory_badge = ""
-        if ctx["compressed"]:
-            memory_badge = f'<span class="memory-badge">🧠 Память ({ctx["summaries_count"]} саммари)</span>'
-        continued_html = ""
-        if continued_from:
-            continued_html = f'<div class="continued-notice">🔄 Продолжение чата "{continued_from}"</div>'
-        context_html = f'''
-        <div class="context-bar">
+    memory_badge = ""
+    if ctx["compressed"]:
+        memory_badge = f'<span class="memory-badge">🧠 Память ({ctx["summaries_count"]} саммари)</span>'
+    if ctx["memory_pending"]:
+        memory_badge += '<span class="memory-badge memory-pending">⏳ Вспоминаю прошлый чат...</span>'
+    continued_html = ""
+    if continued_from:
+        continued_html = f'<div class="continued-notice">🔄 Продолжение чата "{continued_from}"</div>'
+    return f'''
+        <div class="context-bar" id="contextBar">
             <div class="context-info">
                 <span>💬 {ctx["messages"]} сообщений</span>
                 <span>📊 ~{ctx["tokens"]} токенов</span>
@@ -247,7 +807,26 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
             {continued_html}
         </div>'''
 
-    return f'''<!DOCTYPE html>
+
+def render_options(names, selected):
+    return "".join(f'<option value="{name}" {"selected" if name == selected else ""}>{name}</option>' for name in names)
+
+
+def precompute_options(names):
+    # Все варианты списка с каждым выбранным пунктом; None — ничего не выбрано
+    options = {name: render_options(names, name) for name in names}
+    options[None] = render_options(names, None)
+    return options
+
+
+PAGE_SLOTS = ("chat_list", "tokens_total", "session_id", "model_options", "role_options", "context", "messages", "request_id")
+
+
+def build_page_shell():
+    # Статичная разметка страницы собирается один раз: дальше на запрос только
+    # склеиваются готовые куски и переменные места
+    slot = {name: f"\0{name}\0" for name in PAGE_SLOTS}
+    html = f'''<!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
@@ -255,116 +834,7 @@ def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_rol
     <title>AI Чат — Qwen3</title>
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/atom-one-dark.min.css">
     <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"></script>
-    <style>
-* {{ margin: 0; padding: 0; box-sizing: border-box; }}
-:root {{
-    --bg-primary: #0f0c29; --bg-secondary: #302b63; --bg-tertiary: #24243e;
-    --bg-card: rgba(255,255,255,0.05); --bg-input: rgba(255,255,255,0.08);
-    --border: rgba(255,255,255,0.1); --border-hover: rgba(255,255,255,0.3);
-    --text-primary: #fff; --text-secondary: rgba(255,255,255,0.6);
-    --text-muted: rgba(255,255,255,0.4); --accent: #667eea; --accent-2: #764ba2;
-    --user-bubble: linear-gradient(135deg,#667eea,#764ba2);
-    --bot-bubble: rgba(255,255,255,0.1); --sidebar-bg: rgba(15,12,41,0.95);
-}}
-[data-theme="light"] {{
-    --bg-primary: #f0f2f5; --bg-secondary: #e4e6eb; --bg-tertiary: #fff;
-    --bg-card: rgba(0,0,0,0.03); --bg-input: rgba(0,0,0,0.05);
-    --border: rgba(0,0,0,0.1); --border-hover: rgba(0,0,0,0.3);
-    --text-primary: #1a1a2e; --text-secondary: rgba(0,0,0,0.6);
-    --text-muted: rgba(0,0,0,0.4); --bot-bubble: rgba(0,0,0,0.05);
-    --sidebar-bg: rgba(240,242,245,0.98);
-}}
-body {{ font-family:'Segoe UI',system-ui,sans-serif; background:linear-gradient(135deg,var(--bg-primary),var(--bg-secondary),var(--bg-tertiary)); min-height:100vh; display:flex; color:var(--text-primary); }}
-.sidebar {{ width:280px; height:100vh; background:var(--sidebar-bg); backdrop-filter:blur(20px); border-right:1px solid var(--border); display:flex; flex-direction:column; position:fixed; left:-280px; top:0; z-index:100; transition:left .3s; }}
-.sidebar.open {{ left:0; }}
-.sidebar-header {{ display:flex; justify-content:space-between; align-items:center; padding:20px; border-bottom:1px solid var(--border); }}
-.sidebar-close {{ background:none; border:none; color:var(--text-primary); font-size:1.2rem; cursor:pointer; }}
-.new-chat-sidebar-btn {{ display:block; margin:15px; padding:12px; background:var(--bg-input); border:1px dashed var(--border); border-radius:10px; color:var(--text-primary); text-decoration:none; text-align:center; transition:all .3s; }}
-.new-chat-sidebar-btn:hover {{ background:var(--accent); border-style:solid; }}
-.chat-list {{ flex:1; overflow-y:auto; padding:10px; }}
-.chat-item-wrapper {{ display:flex; align-items:center; margin-bottom:5px; border-radius:10px; transition:background .2s; }}
-.chat-item-wrapper:hover {{ background:var(--bg-input); }}
-.chat-item {{ flex:1; display:flex; justify-content:space-between; align-items:center; padding:10px 12px; color:var(--text-primary); text-decoration:none; border-radius:10px; }}
-.chat-item.active {{ background:rgba(102,126,234,0.2); border:1px solid rgba(102,126,234,0.3); }}
-.chat-title {{ flex:1; overflow:hidden; text-overflow:ellipsis; white-space:nowrap; font-size:.9rem; }}
-.chat-meta {{ font-size:.75rem; color:var(--text-muted); white-space:nowrap; }}
-.chat-actions {{ display:flex; gap:2px; opacity:0; transition:opacity .2s; padding-right:8px; }}
-.chat-item-wrapper:hover .chat-actions {{ opacity:1; }}
-.continue-btn,.delete-btn {{ text-decoration:none; font-size:.8rem; padding:4px 6px; border-radius:6px; transition:background .2s; }}
-.continue-btn:hover {{ background:rgba(102,126,234,0.2); }}
-.delete-btn:hover {{ background:rgba(244,67,54,0.2); }}
-.no-chats {{ text-align:center; color:var(--text-muted); padding:20px; font-size:.9rem; }}
-.token-counter {{ padding:15px 20px; border-top:1px solid var(--border); font-size:.85rem; color:var(--text-secondary); }}
-.container {{ flex:1; max-width:900px; margin:0 auto; height:100vh; display:flex; flex-direction:column; }}
-header {{ display:flex; align-items:center; padding:15px 20px; background:var(--bg-card); backdrop-filter:blur(20px); border-bottom:1px solid var(--border); }}
-.menu-btn {{ background:none; border:none; color:var(--text-primary); font-size:1.5rem; cursor:pointer; padding:5px 10px; border-radius:8px; transition:background .2s; }}
-.menu-btn:hover {{ background:var(--bg-input); }}
-.header-center {{ flex:1; text-align:center; }}
-header h1 {{ font-size:1.3rem; }}
-.subtitle {{ font-size:.8rem; color:var(--text-muted); margin-top:2px; }}
-.header-actions {{ display:flex; gap:8px; }}
-.header-actions button,.header-actions a {{ background:var(--bg-input); border:1px solid var(--border); border-radius:8px; color:var(--text-primary); padding:6px 10px; cursor:pointer; text-decoration:none; font-size:1rem; transition:all .2s; }}
-.header-actions button:hover,.header-actions a:hover {{ background:var(--border-hover); }}
-.settings-bar {{ display:flex; gap:15px; padding:12px 20px; background:var(--bg-card); border-bottom:1px solid var(--border); flex-wrap:wrap; }}
-.setting {{ display:flex; align-items:center; gap:8px; flex:1; min-width:200px; }}
-.setting label {{ font-size:.85rem; color:var(--text-secondary); white-space:nowrap; }}
-.setting select {{ flex:1; padding:8px 12px; background:var(--bg-input); border:1px solid var(--border); border-radius:8px; color:var(--text-primary); font-size:.85rem; cursor:pointer; outline:none; }}
-.setting select option {{ background:#1a1a2e; color:#fff; }}
-.context-bar {{ padding:8px 20px; background:var(--bg-card); border-bottom:1px solid var(--border); }}
-.context-info {{ display:flex; gap:15px; font-size:.8rem; color:var(--text-muted); margin-bottom:5px; flex-wrap:wrap; }}
-.memory-badge {{ background:rgba(102,126,234,0.2); padding:2px 8px; border-radius:10px; color:var(--accent); font-size:.75rem; }}
-.context-progress {{ height:4px; background:var(--bg-input); border-radius:2px; overflow:hidden; }}
-.context-progress-bar {{ height:100%; background:linear-gradient(90deg,#4caf50,#ff9800,#f44336); border-radius:2px; transition:width .5s; }}
-.context-warning {{ margin-top:6px; font-size:.8rem; color:#ff9800; padding:6px 10px; background:rgba(255,152,0,0.1); border-radius:8px; border:1px solid rgba(255,152,0,0.2); }}
-.context-warning a {{ color:var(--accent); text-decoration:none; font-weight:600; }}
-.continued-notice {{ margin-top:6px; font-size:.8rem; color:#4caf50; padding:6px 10px; background:rgba(76,175,80,0.1); border-radius:8px; border:1px solid rgba(76,175,80,0.2); }}
-.chat-box {{ flex:1; overflow-y:auto; padding:20px; display:flex; flex-direction:column; gap:15px; }}
-.welcome {{ text-align:center; margin:auto; padding:20px; }}
-.welcome h2 {{ font-size:1.8rem; margin-bottom:10px; }}
-.welcome p {{ color:var(--text-secondary); margin-bottom:25px; }}
-.suggestions {{ display:grid; grid-template-columns:1fr 1fr; gap:10px; }}
-.suggestions button {{ padding:14px 18px; background:var(--bg-input); border:1px solid var(--border); border-radius:12px; color:var(--text-primary); font-size:.9rem; cursor:pointer; transition:all .3s; text-align:left; }}
-.suggestions button:hover {{ background:rgba(102,126,234,0.15); border-color:var(--accent); transform:translateY(-2px); }}
-.message {{ display:flex; gap:12px; align-items:flex-start; animation:fadeIn .3s ease; }}
-@keyframes fadeIn {{ from{{opacity:0;transform:translateY(10px)}} to{{opacity:1;transform:translateY(0)}} }}
-.avatar {{ font-size:1.3rem; width:38px; height:38px; display:flex; align-items:center; justify-content:center; border-radius:50%; background:var(--bg-input); flex-shrink:0; }}
-.bubble {{ padding:14px 18px; border-radius:16px; max-width:80%; line-height:1.6; font-size:.95rem; position:relative; }}
-.user-msg {{ flex-direction:row-reverse; }}
-.user-msg .bubble {{ background:var(--user-bubble); color:#fff; border-bottom-right-radius:4px; white-space:pre-wrap; word-wrap:break-word; }}
-.bot-msg .bubble {{ background:var(--bot-bubble); border:1px solid var(--border); border-bottom-left-radius:4px; }}
-.markdown-content h1,.markdown-content h2,.markdown-content h3 {{ margin:10px 0 5px; }}
-.markdown-content p {{ margin:5px 0; }}
-.markdown-content ul,.markdown-content ol {{ margin:5px 0 5px 20px; }}
-.markdown-content code {{ background:rgba(0,0,0,0.3); padding:2px 6px; border-radius:4px; font-family:'Fira Code',Consolas,monospace; font-size:.85em; }}
-.markdown-content pre {{ background:rgba(0,0,0,0.4); border-radius:10px; padding:15px; margin:10px 0; overflow-x:auto; }}
-.markdown-content pre code {{ background:none; padding:0; }}
-.markdown-content table {{ border-collapse:collapse; margin:10px 0; width:100%; }}
-.markdown-content th,.markdown-content td {{ border:1px solid var(--border); padding:8px 12px; text-align:left; }}
-.markdown-content th {{ background:var(--bg-input); }}
-.markdown-content blockquote {{ border-left:3px solid var(--accent); padding-left:15px; margin:10px 0; color:var(--text-secondary); }}
-.copy-btn {{ position:absolute; top:8px; right:8px; background:var(--bg-input); border:1px solid var(--border); border-radius:6px; padding:4px 8px; cursor:pointer; font-size:.8rem; opacity:0; transition:opacity .2s; }}
-.bubble:hover .copy-btn {{ opacity:1; }}
-.copy-toast {{ position:fixed; bottom:100px; left:50%; transform:translateX(-50%) translateY(20px); background:#4caf50; color:#fff; padding:10px 20px; border-radius:10px; font-size:.9rem; opacity:0; transition:all .3s; z-index:999; pointer-events:none; }}
-.copy-toast.show {{ opacity:1; transform:translateX(-50%) translateY(0); }}
-.input-form {{ display:flex; gap:10px; padding:15px 20px; background:var(--bg-card); border-top:1px solid var(--border); }}
-.input-form input {{ flex:1; padding:14px 20px; border-radius:14px; border:1px solid var(--border); background:var(--bg-input); color:var(--text-primary); font-size:1rem; outline:none; transition:border-color .3s; }}
-.input-form input::placeholder {{ color:var(--text-muted); }}
-.input-form input:focus {{ border-color:var(--accent); }}
-.input-form button {{ width:50px; height:50px; border-radius:14px; border:none; background:linear-gradient(135deg,var(--accent),var(--accent-2)); cursor:pointer; display:flex; align-items:center; justify-content:center; transition:transform .2s; }}
-.input-form button:hover {{ transform:scale(1.05); }}
-.loading {{ padding:15px 20px; background:var(--bg-card); }}
-.loading-dots {{ display:flex; align-items:center; gap:10px; color:var(--text-secondary); font-size:.9rem; }}
-.dots {{ display:flex; gap:4px; }}
-.dot {{ width:8px; height:8px; border-radius:50%; background:var(--accent); animation:bounce 1.4s infinite ease-in-out; }}
-.dot:nth-child(2) {{ animation-delay:.2s; }}
-.dot:nth-child(3) {{ animation-delay:.4s; }}
-@keyframes bounce {{ 0%,80%,100%{{transform:scale(0);opacity:.5}} 40%{{transform:scale(1);opacity:1}} }}
-.sidebar-overlay {{ position:fixed; top:0; left:0; width:100%; height:100%; background:rgba(0,0,0,0.5); z-index:99; display:none; }}
-.sidebar-overlay.show {{ display:block; }}
-.chat-box::-webkit-scrollbar,.chat-list::-webkit-scrollbar {{ width:6px; }}
-.chat-box::-webkit-scrollbar-thumb,.chat-list::-webkit-scrollbar-thumb {{ background:rgba(255,255,255,0.2); border-radius:3px; }}
-@media(max-width:768px) {{ .suggestions{{grid-template-columns:1fr}} .settings-bar{{flex-direction:column;gap:8px}} .setting{{min-width:unset}} .bubble{{max-width:90%}} }}
-    </style>
+    <link rel="stylesheet" href="{static_url("app.css")}">
 </head>
 <body>
     <div class="sidebar" id="sidebar">
@@ -373,8 +843,9 @@ header h1 {{ font-size:1.3rem; }}
             <button class="sidebar-close" onclick="toggleSidebar()">✕</button>
         </div>
         <a href="/new" class="new-chat-sidebar-btn">+ Новый чат</a>
-        <div class="chat-list">{chat_list_html}</div>
-        <div class="token-counter"><span>📊 Токены: ~{token_counter["total"]}</span></div>
+        <input type="search" class="chat-search" id="chatSearch" placeholder="🔍 Поиск по названию..." oninput="searchChats(this.value)" autocomplete="off">
+        <div class="chat-list" id="chatList">{slot["chat_list"]}</div>
+        <div class="token-counter"><span>📊 Токены: ~<span id="tokenTotal">{slot["tokens_total"]}</span></span><a href="/export-all" class="export-all" title="Скачать все чаты (zip)">📦</a></div>
     </div>
 
     <div class="container">
@@ -386,28 +857,29 @@ header h1 {{ font-size:1.3rem; }}
             </div>
             <div class="header-actions">
                 <button class="theme-btn" onclick="toggleTheme()" title="Тема">🌙</button>
-                <a href="/clear/{session_id}" title="Очистить">🗑️</a>
-                <a href="/export/{session_id}" title="Скачать">📥</a>
+                <a href="/clear/{slot["session_id"]}" title="Очистить">🗑️</a>
+                <a href="/export/{slot["session_id"]}" title="Скачать">📥</a>
             </div>
         </header>
 
         <div class="settings-bar">
             <div class="setting">
                 <label>🧠 Модель:</label>
-                <select form="chatForm" name="model_name">{model_options}</select>
+                <select form="chatForm" name="model_name">{slot["model_options"]}</select>
             </div>
             <div class="setting">
                 <label>🎭 Роль:</label>
-                <select form="chatForm" name="role_name">{role_options}</select>
+                <select form="chatForm" name="role_name">{slot["role_options"]}</select>
             </div>
         </div>
 
-        {context_html}
+        {slot["context"]}
 
-        <div class="chat-box" id="chatBox">{messages_html}</div>
+        <div class="chat-box" id="chatBox">{slot["messages"]}</div>
 
-        <form action="/chat" method="post" class="input-form" id="chatForm" onsubmit="showLoading()">
-            <input type="hidden" name="session_id" value="{session_id}">
+        <form action="/chat" method="post" class="input-form" id="chatForm" onsubmit="sendMessage(event)">
+            <input type="hidden" name="session_id" value="{slot["session_id"]}">
+            <input type="hidden" name="request_id" value="{slot["request_id"]}">
             <input type="text" name="user_message" id="userInput" placeholder="Написать сообщение..." autocomplete="off" required>
             <button type="submit" id="sendBtn">
                 <svg width="24" height="24" viewBox="0 0 24 24" fill="none"><path d="M2 21L23 12L2 3V10L17 12L2 14V21Z" fill="white"/></svg>
@@ -424,123 +896,566 @@ header h1 {{ font-size:1.3rem; }}
 
     <div class="copy-toast" id="copyToast">✅ Скопировано!</div>
 
-    <script>
-    window.onload=function(){{scrollToBottom();document.getElementById('userInput').focus();hljs.highlightAll();const t=localStorage.getItem('theme')||'dark';if(t==='light'){{document.documentElement.setAttribute('data-theme','light');document.querySelector('.theme-btn').textContent='☀️'}}}};
-    function scrollToBottom(){{const c=document.getElementById('chatBox');c.scrollTop=c.scrollHeight}}
-    function showLoading(){{document.getElementById('loading').style.display='block';const b=document.getElementById('sendBtn');b.disabled=true;b.style.opacity='0.5';const c=document.getElementById('chatBox');const w=c.querySelector('.welcome');if(w)w.remove();const i=document.getElementById('userInput');const d=document.createElement('div');d.className='message user-msg';d.innerHTML='<div class="avatar">👤</div><div class="bubble">'+escapeHtml(i.value)+'</div>';c.appendChild(d);scrollToBottom()}}
-    function copyMessage(btn){{const b=btn.closest('.bubble');const c=b.querySelector('.markdown-content');const t=c?c.innerText:b.innerText;navigator.clipboard.writeText(t).then(()=>{{const toast=document.getElementById('copyToast');toast.classList.add('show');setTimeout(()=>toast.classList.remove('show'),2000)}})}}
-    function toggleTheme(){{const h=document.documentElement;const b=document.querySelector('.theme-btn');if(h.getAttribute('data-theme')==='light'){{h.removeAttribute('data-theme');b.textContent='🌙';localStorage.setItem('theme','dark')}}else{{h.setAttribute('data-theme','light');b.textContent='☀️';localStorage.setItem('theme','light')}}}}
-    function toggleSidebar(){{const s=document.getElementById('sidebar');let o=document.querySelector('.sidebar-overlay');if(!o){{o=document.createElement('div');o.className='sidebar-overlay';o.onclick=toggleSidebar;document.body.appendChild(o)}};s.classList.toggle('open');o.classList.toggle('show')}}
-    function fillQuestion(t){{document.getElementById('userInput').value=t;document.getElementById('userInput').focus()}}
-    function escapeHtml(t){{const d=document.createElement('div');d.innerText=t;return d.innerHTML}}
-    document.addEventListener('keydown',function(e){{if(e.key==='Enter'&&!e.shiftKey){{const i=document.getElementById('userInput');if(document.activeElement===i&&i.value.trim()){{document.getElementById('chatForm').submit();showLoading()}}}}}});
-    </script>
+    <script src="{static_url("app.js")}"></script>
 </body>
 </html>'''
+    return html.split("\0")
+
+
+async def render_page(session_id, messages, selected_model="Qwen3 Coder", selected_role="Ассистент", current_chat_id="", continued_from=""):
+    # В страницу попадают только последние сообщения, ранние подгружаются фрагментами
+    if messages:
+        before = max(0, len(messages) - PAGE_MESSAGES)
+        messages_html = render_load_earlier(before) + await render_messages(messages[before:])
+    else:
+        messages_html = render_welcome(continued_from)
+    values = {
+        "chat_list": render_chat_list(current_chat_id),
+        "tokens_total": str(token_counter["total"]),
+        "session_id": session_id,
+        "model_options": MODEL_OPTIONS.get(selected_model, MODEL_OPTIONS[None]),
+        "role_options": ROLE_OPTIONS.get(selected_role, ROLE_OPTIONS[None]),
+        "context": render_context_bar(session_id, continued_from),
+        "messages": messages_html,
+        "request_id": str(uuid.uuid4()),
+    }
+    parts = [PAGE_SHELL[0]]
+    for i in range(1, len(PAGE_SHELL), 2):
+        parts.append(values[PAGE_SHELL[i]])
+        parts.append(PAGE_SHELL[i + 1])
+    return "".join(parts)
+
+
+with STARTUP.step("page_shell"):
+    MODEL_OPTIONS = precompute_options(MODELS)
+    ROLE_OPTIONS = precompute_options(ROLES)
+    PAGE_SHELL = build_page_shell()
 
 
 @app.get("/", response_class=HTMLResponse)
 async def home():
-    sid = str(uuid.uuid4())
-    chat_sessions[sid] = {"messages": [], "model": "Qwen3 Coder", "role": "Ассистент", "summaries": []}
-    return HTMLResponse(render_page(sid, []))
+    # Сессия создаётся только при первом сообщении
+    return HTMLResponse(await render_page(str(uuid.uuid4()), []))
 
 
-@app.post("/chat", response_class=HTMLResponse)
-async def chat(user_message: str = Form(...), session_id: str = Form(...), model_name: str = Form("Qwen3 Coder"), role_name: str = Form("Ассистент")):
-    if session_id not in chat_sessions:
-        chat_sessions[session_id] = {"messages": [], "model": model_name, "role": role_name, "summaries": []}
-    session = chat_sessions[session_id]
-    session["model"] = model_name
-    session["role"] = role_name
-    session["messages"].append({"role": "user", "content": user_message, "html": user_message})
+def start_turn(session_id, user_message, model_name, role_name):
+    def apply(session):
+        if session is None:
+            session = {"messages": [], "model": model_name, "role": role_name, "summaries": []}
+        session["model"] = model_name
+        session["role"] = role_name
+        session["messages"].append(Message("user", user_message))
+        return session
+
+    return sessions.update(session_id, apply)
+
+
+def finish_turn(session_id, user_message, bot_reply, error=False, info=None):
+    # Сессия перечитывается: пока шёл ответ, другой воркер мог сжать историю
+    def apply(session):
+        if session is None:
+            session = {"messages": [], "summaries": []}
+        session["messages"].append(Message("assistant", bot_reply, error=error))
+        if info is not None and "prompt_prefix" in info:
+            session["prompt_prefix"] = info["prompt_prefix"]
+        if "title" not in session:
+            session["title"] = user_message[:30] + ("..." if len(user_message) > 30 else "")
+        return session
+
+    return sessions.update(session_id, apply)
+
+
+def record_usage(info, role_name, user_message, bot_reply):
+    # Реальные токены из usage; если провайдер их не прислал — оценка по токенизатору
+    model_id = info.get("model_id", "")
+    usage = info.get("usage")
+    if usage is not None:
+        LLM_TOKENS.inc(model_id, role_name, "prompt", amount=usage.prompt_tokens)
+        LLM_TOKENS.inc(model_id, role_name, "completion", amount=usage.completion_tokens)
+        # Провайдеры с кэшем промптов сообщают, сколько токенов взято из кэша
+        cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+        if cached:
+            LLM_TOKENS.inc(model_id, role_name, "cached", amount=cached)
+        token_counter["total"] += usage.total_tokens
+    else:
+        token_counter["total"] += count_tokens(user_message + bot_reply, model_id)
+
+
+def client_key(request, session_id=""):
+    if RATE_LIMIT_KEY == "session" and session_id:
+        return session_id
+    forwarded = request.headers.get("x-forwarded-for") if TRUST_PROXY_HOPS else None
+    if forwarded:
+        hops = [h.strip() for h in forwarded.split(",")]
+        # Адрес, который записал ближайший к клиенту доверенный прокси
+        if len(hops) >= TRUST_PROXY_HOPS:
+            return hops[-TRUST_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+def admit(user):
+    # Отказ до сохранения сообщения: лимит пользователя и переполненная очередь
+    rate_limiter.check(user)
+    scheduler.check()
+
+
+def too_many_requests(e):
+    return JSONResponse({"error": str(e), "retry_after": e.retry_after}, 429, headers={"Retry-After": str(e.retry_after)})
+
+
+@asynccontextmanager
+async def upstream_slot(user, model_id, trace=None):
+    # Слот держится всё время ответа модели, включая весь поток
+    with trace.span("queue") if trace is not None else nullcontext():
+        acquired = await scheduler.acquire(user, MODEL_COSTS.get(model_id, 1.0), model_id)
+    try:
+        yield
+    finally:
+        scheduler.release(acquired)
+
+
+def error_html(bot_reply):
+    return f"<p style='color:#ff6b6b'>⚠️ {bot_reply}</p>"
+
+
+def turn_key(kind, session_id, request, request_id, user_message, model_name, role_name):
+    # Явный ключ идемпотентности (заголовок или поле формы) или само содержимое сообщения
+    explicit = request.headers.get("idempotency-key") or request_id
+    if explicit:
+        return (kind, session_id, explicit), IDEMPOTENCY_TTL
+    digest = hashlib.sha256(f"{model_name}\0{role_name}\0{user_message}".encode("utf-8")).hexdigest()
+    return (kind, session_id, digest), 0.0
+
+
+async def chat_turn(user, session_id, user_message, model_name, role_name, no_cache):
+    trace = Trace()
     model_id = MODELS.get(model_name, MODELS["Qwen3 Coder"])
-    compress_history(session, model_id)
+    info = {"model_id": model_id}
+    with trace.span("memory"):
+        await memory_ready(user, session_id)
+    async with session_locks.hold(session_id):
+        with trace.span("session"):
+            session = start_turn(session_id, user_message, model_name, role_name)
+        try:
+            with trace.span("recall"):
+                recalled = await recall_memory(session, session_id)
+            with trace.span("build_api_messages"):
+                api_messages = build_api_messages(session, role_name, model_id, info, recalled)
+                track_prompt_prefix(session, api_messages, info)
+            bot_reply = lookup_cache(model_id, api_messages, 0.7, no_cache)
+            if bot_reply is None:
+                async with upstream_slot(user, model_id, trace):
+                    with trace.span("upstream_total"):
+                        response = await create_completion(model_id, api_messages, MAX_TOKENS_RESPONSE, 0.7, info)
+                bot_reply = response.choices[0].message.content
+                store_cache(info, api_messages, 0.7, bot_reply)
+            # Рендер вне цикла событий; страница ниже возьмёт готовый HTML из кэша
+            with trace.span("md_to_html"):
+                await render_markdown(bot_reply)
+            record_usage(info, role_name, user_message, bot_reply)
+            failed = False
+        except Exception as e:
+            bot_reply = f"Ошибка: {str(e)}"
+            failed = True
+        session = finish_turn(session_id, user_message, bot_reply, failed, info)
+    schedule_compression(session_id, session, model_id)
+    with trace.span("render_page"):
+        page = await render_page(session_id, session["messages"], model_name, role_name, session_id)
+    return page, trace.header()
+
+
+async def stream_turn(user, session_id, user_message, model_name, role_name, no_cache):
+    trace = Trace()
+    model_id = MODELS.get(model_name, MODELS["Qwen3 Coder"])
+    info = {"model_id": model_id}
+    with trace.span("memory"):
+        await memory_ready(user, session_id)
+    async with session_locks.hold(session_id):
+        with trace.span("session"):
+            session = start_turn(session_id, user_message, model_name, role_name)
+        parts = []
+        finished = False
+        renderer = IncrementalRenderer()
+        rendered_at = time.monotonic()
+        try:
+            with trace.span("recall"):
+                recalled = await recall_memory(session, session_id)
+            with trace.span("build_api_messages"):
+                api_messages = build_api_messages(session, role_name, model_id, info, recalled)
+                track_prompt_prefix(session, api_messages, info)
+            cached = lookup_cache(model_id, api_messages, 0.7, no_cache)
+            source = replay_reply(cached) if cached is not None else admitted_stream(user, model_id, trace, stream_completion(model_id, api_messages, MAX_TOKENS_RESPONSE, 0.7, info))
+            upstream_started = time.perf_counter()
+            async with aclosing(source) as deltas:
+                async for delta in deltas:
+                    if not parts:
+                        trace.add("upstream_ttft", time.perf_counter() - upstream_started)
+                    parts.append(delta)
+                    renderer.feed(delta)
+                    yield sse_event("delta", {"text": delta})
+                    if time.monotonic() - rendered_at >= STREAM_RENDER_INTERVAL:
+                        stable_html, tail_html = await renderer.flush()
+                        rendered_at = time.monotonic()
+                        # Опоздавшим нужен только последний хвост — прежние в журнале без него
+                        yield sse_event("render", {"append": stable_html, "tail": tail_html}), sse_event("render", {"append": stable_html, "tail": ""})
+            trace.add("upstream_total", time.perf_counter() - upstream_started)
+            bot_reply = "".join(parts)
+            if cached is None:
+                store_cache(info, api_messages, 0.7, bot_reply)
+            with trace.span("md_to_html"):
+                bot_html = await render_markdown(bot_reply)
+            record_usage(info, role_name, user_message, bot_reply)
+            session = finish_turn(session_id, user_message, bot_reply, info=info)
+            finished = True
+            yield sse_event("done", {"html": bot_html, "tokens_total": token_counter["total"], "timings": trace.timings(), "prompt": info["prompt"]})
+            schedule_compression(session_id, session, model_id)
+        except Exception as e:
+            if not finished:
+                bot_reply = f"Ошибка: {str(e)}"
+                finish_turn(session_id, user_message, bot_reply, error=True, info=info)
+                finished = True
+                yield sse_event("error", {"html": error_html(bot_reply)})
+        finally:
+            # Все клиенты ушли посреди генерации — сохраняем то, что успели получить
+            if not finished:
+                bot_reply = "".join(parts)
+                finish_turn(session_id, user_message, bot_reply, info=info)
+
+
+@app.post("/chat", response_class=HTMLResponse)
+async def chat(request: Request, user_message: str = Form(...), session_id: str = Form(...), model_name: str = Form("Qwen3 Coder"), role_name: str = Form("Ассистент"), no_cache: bool = Form(False), request_id: str = Form("")):
+    key, linger = turn_key("page", session_id, request, request_id, user_message, model_name, role_name)
+    flight = turns.get(key)
+    if flight is None:
+        # Повтор того же сообщения присоединяется к идущей генерации, а не запускает вторую
+        user = client_key(request, session_id)
+        try:
+            admit(user)
+        except Overloaded as e:
+            return too_many_requests(e)
+        flight = turns.start(key, lambda f: chat_turn(user, session_id, user_message, model_name, role_name, no_cache), linger)
+    page, timing = await asyncio.shield(flight.task)
+    return HTMLResponse(page, headers={"Server-Timing": timing})
+
+
+def final_event(events):
+    # После конца хода повтору достаточно итога: done/error несут готовый HTML ответа
+    if events and events[-1].startswith(("event: done", "event: error")):
+        return events[-1:]
+    return events
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request, user_message: str = Form(...), session_id: str = Form(...), model_name: str = Form("Qwen3 Coder"), role_name: str = Form("Ассистент"), no_cache: bool = Form(False), request_id: str = Form("")):
+    key, linger = turn_key("stream", session_id, request, request_id, user_message, model_name, role_name)
+    flight = turns.get(key)
+    if flight is None:
+        user = client_key(request, session_id)
+        try:
+            admit(user)
+        except Overloaded as e:
+            return too_many_requests(e)
+        flight = turns.start(key, lambda f: f.drain(stream_turn(user, session_id, user_message, model_name, role_name, no_cache)), linger, compact=final_event)
+    return StreamingResponse(flight.follow(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@asynccontextmanager
+async def batch_slot(job_id, model_id):
+    # Вся задача — один поток в справедливой очереди, поэтому сотни запросов не
+    # вытесняют чаты. Переполненная очередь для фоновой работы не ошибка: ждём и пробуем снова
+    while True:
+        try:
+            acquired = await scheduler.acquire(f"batch:{job_id}", MODEL_COSTS.get(model_id, 1.0), model_id)
+            break
+        except Overloaded as e:
+            await asyncio.sleep(e.retry_after)
+    try:
+        yield
+    finally:
+        scheduler.release(acquired)
+
+
+async def batch_item(job_id, idx, item):
+    model_id = MODELS[item["model"]]
+    info = {"model_id": model_id}
+    api_messages = [{"role": "system", "content": ROLES[item["role"]]}, {"role": "user", "content": item["prompt"]}]
+    result = {"type": "result", "index": idx, "id": item["id"], "model": item["model"], "role": item["role"]}
     try:
-        api_messages = build_api_messages(session, role_name)
-        response = client.chat.completions.create(model=model_id, messages=api_messages, max_tokens=MAX_TOKENS_RESPONSE, temperature=0.7)
-        bot_reply = response.choices[0].message.content
-        bot_html = md_to_html(bot_reply)
-        token_counter["total"] += estimate_tokens(user_message + bot_reply)
+        reply = lookup_cache(model_id, api_messages, BATCH_TEMPERATURE)
+        if reply is None:
+            async with batch_slot(job_id, model_id):
+                response = await create_completion(model_id, api_messages, MAX_TOKENS_RESPONSE, BATCH_TEMPERATURE, info)
+            reply = response.choices[0].message.content
+            store_cache(info, api_messages, BATCH_TEMPERATURE, reply)
+        record_usage(info, item["role"], item["prompt"], reply)
+        result["content"] = reply
+        batch_store.put_result(job_id, idx, result)
     except Exception as e:
-        bot_reply = f"Ошибка: {str(e)}"
-        bot_html = f"<p style='color:#ff6b6b'>⚠️ {bot_reply}</p>"
-    session["messages"].append({"role": "assistant", "content": bot_reply, "html": bot_html})
-    if "title" not in session:
-        session["title"] = user_message[:30] + ("..." if len(user_message) > 30 else "")
-    return HTMLResponse(render_page(session_id, session["messages"], model_name, role_name, session_id))
+        # Ошибки не сохраняются — при продолжении задачи запрос выполнится заново
+        result.pop("content", None)
+        result["error"] = str(e)
+    return result
+
+
+async def batch_lines(job_id, items):
+    # Сначала уже готовые результаты, затем остальные — по мере завершения, не по порядку
+    results = batch_store.results(job_id)
+    yield jsonl_line({"type": "job", "id": job_id, "total": len(items), "done": len(results)})
+    for idx in sorted(results):
+        yield jsonl_line(results[idx])
+    pending = [(idx, item) for idx, item in enumerate(items) if idx not in results]
+    failed = 0
+    async with aclosing(bounded_map(lambda p: batch_item(job_id, *p), pending, BATCH_CONCURRENCY)) as done:
+        async for result in done:
+            failed += "error" in result
+            yield jsonl_line(result)
+    yield jsonl_line({"type": "done", "id": job_id, "completed": len(items) - failed, "failed": failed})
+
+
+def drop_results(events):
+    # Готовые результаты уже в batch_store — продолжение задачи читает их оттуда
+    return []
+
+
+def follow_batch(job_id, flight):
+    # Задача не привязана к соединению: отключившийся клиент продолжит её по id
+    return StreamingResponse(flight.follow(), media_type="application/x-ndjson", headers={"X-Batch-Id": job_id, "X-Accel-Buffering": "no"})
+
+
+@app.post("/api/batch")
+async def create_batch(request: Request):
+    try:
+        items = parse_jsonl(await request.body(), MODELS, ROLES, BATCH_MAX_ITEMS)
+    except BatchError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    try:
+        rate_limiter.check(client_key(request))
+    except Overloaded as e:
+        return too_many_requests(e)
+    job_id = batch_store.create(items)
+    flight = batch_jobs.start(job_id, lambda f: f.drain(batch_lines(job_id, items)), cancel_on_leave=False, compact=drop_results)
+    return follow_batch(job_id, flight)
+
+
+@app.get("/api/batch/{job_id}")
+async def resume_batch(job_id: str):
+    flight = batch_jobs.get(job_id)
+    if flight is None:
+        items = batch_store.items(job_id)
+        if items is None:
+            return JSONResponse({"error": "Not found"}, 404)
+        flight = batch_jobs.start(job_id, lambda f: f.drain(batch_lines(job_id, items)), cancel_on_leave=False, compact=drop_results)
+    return follow_batch(job_id, flight)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/models")
+async def models_health():
+    return JSONResponse({name: router.model(model_id).snapshot() for name, model_id in MODELS.items()})
+
+
+@app.get("/healthz")
+async def health():
+    # Для Render и для замеров холодного старта: куда ушло время и что ещё не загружено
+    return JSONResponse({
+        "status": "ok",
+        "uptime": round(time.monotonic() - STARTUP.process_started, 3),
+        "lazy_startup": LAZY_STARTUP,
+        "startup": STARTUP.snapshot(),
+        "loaded": {"upstream_client": client is not None, "markdown": "markdown" in sys.modules, "numpy": "numpy" in sys.modules},
+    })
+
+
+@app.get("/api/queue")
+async def queue_stats():
+    return JSONResponse(scheduler.snapshot())
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    if completion_cache is None:
+        return JSONResponse({"enabled": False})
+    return JSONResponse(dict(completion_cache.info(), enabled=True))
+
+
+@app.get("/static/{name}")
+async def static_asset(name: str, request: Request):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        return JSONResponse({"error": "Not found"}, 404)
+    media_type, digest, variants = asset
+    etag = f'"{digest}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag, "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    accept = request.headers.get("accept-encoding", "")
+    for encoding in ("br", "gzip"):
+        if encoding in variants and encoding in accept:
+            headers["Content-Encoding"] = encoding
+            return Response(variants[encoding], media_type=media_type, headers=headers)
+    return Response(variants["identity"], media_type=media_type, headers=headers)
+
+
+@app.get("/fragments/chats", response_class=HTMLResponse)
+async def chats_fragment(current: str = "", before: int | None = None, q: str = ""):
+    return HTMLResponse(render_chat_list(current, before, q.strip()))
+
+
+@app.get("/api/chats")
+async def chats_api(before: int | None = None, q: str = ""):
+    chats, next_cursor = get_chat_list(before, q.strip())
+    return JSONResponse({"chats": chats, "next": next_cursor})
+
+
+@app.get("/fragments/context/{session_id}", response_class=HTMLResponse)
+async def context_fragment(session_id: str, request: Request):
+    # Страница опрашивает полосу, пока висит пометка о памяти — здесь же подхватываем
+    # суммаризацию, потерянную при рестарте, иначе опрос не кончится никогда
+    schedule_continuation(client_key(request, session_id), session_id, sessions.get(session_id))
+    return HTMLResponse(render_context_bar(session_id))
+
+
+@app.get("/fragments/messages/{session_id}", response_class=HTMLResponse)
+async def messages_fragment(session_id: str, before: int = 0):
+    s = sessions.get(session_id)
+    if s is None:
+        return HTMLResponse("", 404)
+    before = min(max(before, 0), len(s["messages"]))
+    start = max(0, before - PAGE_MESSAGES)
+    return HTMLResponse(await render_messages(s["messages"][start:before]), headers={"X-Next-Before": str(start)})
 
 
 @app.get("/new", response_class=HTMLResponse)
 async def new_chat():
-    sid = str(uuid.uuid4())
-    chat_sessions[sid] = {"messages": [], "model": "Qwen3 Coder", "role": "Ассистент", "summaries": []}
-    return HTMLResponse(render_page(sid, []))
+    return HTMLResponse(await render_page(str(uuid.uuid4()), []))
 
 
 @app.get("/chat/{session_id}", response_class=HTMLResponse)
 async def load_chat(session_id: str):
-    if session_id not in chat_sessions:
+    trace = Trace()
+    with trace.span("session"):
+        s = sessions.get(session_id)
+    if s is None:
         return await new_chat()
-    s = chat_sessions[session_id]
-    return HTMLResponse(render_page(session_id, s["messages"], s.get("model", "Qwen3 Coder"), s.get("role", "Ассистент"), session_id))
+    with trace.span("render_page"):
+        page = await render_page(session_id, s["messages"], s.get("model", "Qwen3 Coder"), s.get("role", "Ассистент"), session_id)
+    return HTMLResponse(page, headers={"Server-Timing": trace.header()})
 
 
 @app.get("/clear/{session_id}", response_class=HTMLResponse)
 async def clear_chat(session_id: str):
-    if session_id in chat_sessions:
-        m = chat_sessions[session_id].get("model", "Qwen3 Coder")
-        r = chat_sessions[session_id].get("role", "Ассистент")
-        chat_sessions[session_id] = {"messages": [], "model": m, "role": r, "summaries": []}
-    return HTMLResponse(render_page(session_id, [], m, r))
+    m, r = "Qwen3 Coder", "Ассистент"
+    def apply(s):
+        nonlocal m, r
+        if s is None:
+            return None
+        m = s.get("model", m)
+        r = s.get("role", r)
+        # Номера кусков памяти не переиспользуются, чтобы чужие индексы не приняли старые куски за новые
+        end = s.get("memory_seq", 0)
+        return {"messages": [], "model": m, "role": r, "summaries": [], "memory_start": end, "memory_seq": end}
+
+    async with session_locks.hold(session_id):
+        sessions.update(session_id, apply)
+    memory_store.drop(session_id)
+    return HTMLResponse(await render_page(session_id, [], m, r))
 
 
 @app.get("/delete/{session_id}", response_class=HTMLResponse)
 async def delete_chat(session_id: str):
-    if session_id in chat_sessions:
-        del chat_sessions[session_id]
+    async with session_locks.hold(session_id):
+        sessions.delete(session_id)
+    memory_store.drop(session_id)
     return await new_chat()
 
 
 @app.get("/continue/{old_session_id}", response_class=HTMLResponse)
-async def continue_chat(old_session_id: str):
+async def continue_chat(old_session_id: str, request: Request):
     new_sid = str(uuid.uuid4())
-    old = chat_sessions.get(old_session_id, {})
+    old = sessions.get(old_session_id) or {}
     old_model = old.get("model", "Qwen3 Coder")
     old_role = old.get("role", "Ассистент")
     old_title = old.get("title", "Старый чат")
     model_id = MODELS.get(old_model, MODELS["Qwen3 Coder"])
-    old_summaries = old.get("summaries", [])
-    final_summary = ""
-    if old.get("messages"):
-        old_text = ""
-        for msg in old["messages"]:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            old_text += f"{role}: {msg['content']}\n\n"
-        try:
-            sr = client.chat.completions.create(model=model_id, messages=[{"role": "system", "content": "Сделай подробное краткое содержание. Сохрани ВСЕ детали. Пиши на русском."}, {"role": "user", "content": f"Диалог:\n\n{old_text}"}], max_tokens=3000, temperature=0.3)
-            final_summary = sr.choices[0].message.content
-        except:
-            final_summary = old_text[:3000]
-    all_summaries = old_summaries.copy()
-    if final_summary:
-        all_summaries.append(final_summary)
-    chat_sessions[new_sid] = {"messages": [], "model": old_model, "role": old_role, "summaries": all_summaries, "continued_from": old_title}
-    return HTMLResponse(render_page(new_sid, [], old_model, old_role, continued_from=old_title))
+    # Старые саммари переносятся как есть, новая работа — только несжатый хвост
+    summaries = list(old.get("summaries", []))
+    new_session = {"messages": [], "model": old_model, "role": old_role, "summaries": summaries, "continued_from": old_title}
+    tail = old.get("messages", [])
+    if MEMORY_MODE == "retrieval":
+        # Память старого чата и его хвост переезжают целиком — подробности найдутся по запросу
+        start, end = memory_range(old)
+        memory_store.chunks.copy(old_session_id, new_sid, start, end)
+        new_session["memory_start"], new_session["memory_seq"] = start, end
+        chunks = chunk_turns(tail)
+        seq = reserve_chunks(new_session, chunks)
+        memory_store.remember(new_sid, seq, chunks, memory_range(new_session)[0])
+    pending = None
+    if tail:
+        key = tail_key(tail)
+        summary = tail_summaries.get(key)
+        if summary is None and count_history_tokens(tail, model_id) <= CONTINUE_RAW_TAIL_TOKENS:
+            summary = f"Последние сообщения прошлого чата:\n\n{dialog_text(tail)}"
+        if summary is not None:
+            summaries.append(summary)
+        else:
+            user = client_key(request, old_session_id)
+            delay = 0
+            try:
+                admit(user)
+            except Overloaded as e:
+                # Переход по ссылке: вместо JSON-ошибки чат открывается с пометкой о памяти,
+                # а суммаризация хвоста повторится, когда очередь освободится
+                delay = e.retry_after
+            new_session["memory_pending"] = {"tail": tail, "key": key, "position": len(summaries)}
+            pending = (user, delay)
+    sessions.put(new_sid, new_session)
+    if pending is not None:
+        user, delay = pending
+        schedule_continuation(user, new_sid, new_session, delay)
+    return HTMLResponse(await render_page(new_sid, [], old_model, old_role, continued_from=old_title))
+
+
+def iter_all_chats():
+    # Обход по индексу активности страницами, как в списке чатов
+    before = None
+    while True:
+        page = sessions.recent(CHAT_LIST_PAGE, before)
+        if not page:
+            return
+        for chat in page:
+            session = sessions.peek(chat["id"])
+            if session is not None:
+                yield chat["id"], session
+        before = page[-1]["version"]
 
 
 @app.get("/export/{session_id}")
-async def export_chat(session_id: str):
-    if session_id not in chat_sessions:
+async def export_chat(session_id: str, format: str = "txt"):
+    s = sessions.get(session_id)
+    if s is None:
         return JSONResponse({"error": "Not found"}, 404)
-    s = chat_sessions[session_id]
-    text = f"=== AI Chat Export ===\nМодель: {s.get('model')}\nРоль: {s.get('role')}\n{'='*40}\n\n"
-    if s.get("summaries"):
-        text += "📝 КОНТЕКСТ:\n"
-        for i, sm in enumerate(s["summaries"], 1):
-            text += f"\n--- Саммари {i} ---\n{sm}\n"
-        text += "\n" + "=" * 40 + "\n\n"
-    for msg in s["messages"]:
-        r = "👤 Вы" if msg["role"] == "user" else "🤖 AI"
-        text += f"{r}:\n{msg['content']}\n\n{'─'*40}\n\n"
-    return StreamingResponse(iter([text]), media_type="text/plain", headers={"Content-Disposition": f"attachment; filename=chat_{session_id[:8]}.txt"})
+    if format not in EXPORT_FORMATS:
+        return JSONResponse({"error": "Unknown format"}, 400)
+    render, media_type = EXPORT_FORMATS[format]
+    # Синхронный генератор Starlette крутит в пуле потоков — цикл событий не ждёт
+    return StreamingResponse(render(s, session_id), media_type=media_type, headers={"Content-Disposition": f"attachment; filename=chat_{session_id[:8]}.{format}"})
+
+
+@app.get("/export-all")
+async def export_all(format: str = "md"):
+    if format not in EXPORT_FORMATS:
+        return JSONResponse({"error": "Unknown format"}, 400)
+    filename = f"chats_{time.strftime('%Y%m%d')}.zip"
+    return StreamingResponse(zip_chunks(iter_all_chats(), format), media_type="application/zip", headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+if not LAZY_STARTUP:
+    with STARTUP.step("warm_up"):
+        upstream_client()
+        md_to_html("**warm**")
+        load_numpy()
+STARTUP.add("module", time.perf_counter() - IMPORT_STARTED)
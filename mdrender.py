@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+EXTENSIONS = ['fenced_code', 'tables', 'nl2br']
+MARKDOWN_WORKERS = int(os.environ.get("MARKDOWN_WORKERS", "2"))
+MARKDOWN_CACHE_MB = int(os.environ.get("MARKDOWN_CACHE_MB", "32"))
+# Короткие тексты дешевле отрендерить сразу, чем гонять через пул
+INLINE_LIMIT = 2000
+
+_local = threading.local()
+_pool = ThreadPoolExecutor(max_workers=MARKDOWN_WORKERS, thread_name_prefix="markdown")
+
+
+def converter():
+    # Markdown() дорогой в создании — держим по экземпляру на поток;
+    # сам пакет импортируется при первом рендере, а не при старте
+    md = getattr(_local, "md", None)
+    if md is None:
+        import markdown
+        md = _local.md = markdown.Markdown(extensions=EXTENSIONS)
+    return md
+
+
+def render(text):
+    if not text:
+        return ""
+    md = converter()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+
+class HtmlCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        nbytes = len(html)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = html
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+
+html_cache = HtmlCache(MARKDOWN_CACHE_MB * 1024 * 1024)
+
+
+def content_key(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def md_to_html(text):
+    if not text:
+        return ""
+    key = content_key(text)
+    html = html_cache.get(key)
+    if html is None:
+        html = render(text)
+        html_cache.put(key, html)
+    return html
+
+
+async def render_markdown(text):
+    if not text:
+        return ""
+    if len(text) < INLINE_LIMIT:
+        return md_to_html(text)
+    html = html_cache.get(content_key(text))
+    if html is not None:
+        return html
+    return await asyncio.get_running_loop().run_in_executor(_pool, md_to_html, text)
+
+
+async def render_many(texts):
+    # HTML для нескольких текстов сразу; промахи кэша рендерятся в пуле параллельно
+    return await asyncio.gather(*(render_markdown(text) for text in texts))
+
+
+class IncrementalRenderer:
+    # Рендер растущего ответа: готовые блоки (до пустой строки вне ```) рендерятся
+    # один раз, заново рендерится только незаконченный хвост
+    def __init__(self):
+        self.parts = []
+        self.text = ""
+        self.done_upto = 0
+        self.scan_pos = 0
+        self.fence = None
+
+    def feed(self, delta):
+        self.parts.append(delta)
+
+    def split(self):
+        if self.parts:
+            self.text += "".join(self.parts)
+            self.parts = []
+        stable_end = self.done_upto
+        while True:
+            nl = self.text.find("\n", self.scan_pos)
+            if nl < 0:
+                break
+            stripped = self.text[self.scan_pos:nl].strip()
+            if self.fence:
+                if stripped.startswith(self.fence):
+                    self.fence = None
+            elif stripped.startswith("```") or stripped.startswith("~~~"):
+                self.fence = stripped[:3]
+            elif not stripped:
+                stable_end = nl + 1
+            self.scan_pos = nl + 1
+        stable = self.text[self.done_upto:stable_end]
+        self.done_upto = stable_end
+        return stable, self.text[stable_end:]
+
+    def render_parts(self, stable, tail):
+        return (md_to_html(stable) if stable.strip() else ""), render(tail)
+
+    async def flush(self):
+        stable, tail = self.split()
+        if len(stable) + len(tail) < INLINE_LIMIT:
+            return self.render_parts(stable, tail)
+        return await asyncio.get_running_loop().run_in_executor(_pool, self.render_parts, stable, tail)
@@ -0,0 +1,254 @@
+import asyncio
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+np = None
+_numpy_checked = False
+
+# Долговременная память чата: сообщения, ушедшие из окна при сжатии, режутся на куски,
+# каждый кусок — хешированный вектор n-грамм. На ход в промпт попадают только top-k.
+# Тексты кусков лежат в отдельной таблице с номерами seq по порядку, в сессии — только
+# границы [memory_start, memory_seq): строка чата не раздувается и не переписывается целиком
+MEMORY_DIM = int(os.environ.get("MEMORY_DIM", "512"))
+MEMORY_INDEX_CACHE = int(os.environ.get("MEMORY_INDEX_CACHE", "64"))
+MEMORY_MAX_CHUNKS = 2000
+CHUNK_CHARS = 1200
+WORD_RE = re.compile(r"\w+")
+
+
+def load_numpy():
+    # numpy нужен только поиску по памяти — импортируется при первом индексе, а не при старте
+    global np, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np
+
+
+def features(text):
+    # Слова целиком и символьные триграммы: ловят и точные термины, и словоформы
+    for word in WORD_RE.findall(text.lower()):
+        yield word
+        if len(word) > 3:
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+
+@lru_cache(maxsize=1 << 16)
+def bucket(feature):
+    # Слова и триграммы сильно повторяются — хеш считается один раз
+    h = zlib.crc32(feature.encode("utf-8"))
+    return h % MEMORY_DIM, 1.0 if h & 0x80000000 else -1.0
+
+
+def embed(text):
+    vec = {}
+    for feature in features(text):
+        i, sign = bucket(feature)
+        vec[i] = vec.get(i, 0.0) + sign
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    if not norm:
+        return {}
+    return {i: v / norm for i, v in vec.items() if v}
+
+
+def split_text(text):
+    # Куски по абзацам, не длиннее CHUNK_CHARS (длинный абзац режется по пробелу)
+    chunk = ""
+    for para in text.split("\n\n"):
+        while len(para) > CHUNK_CHARS:
+            if chunk:
+                yield chunk
+                chunk = ""
+            cut = para.rfind(" ", 0, CHUNK_CHARS) + 1 or CHUNK_CHARS
+            yield para[:cut]
+            para = para[cut:]
+        if chunk and len(chunk) + len(para) + 2 > CHUNK_CHARS:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n\n{para}" if chunk else para
+    if chunk.strip():
+        yield chunk
+
+
+def chunk_turns(messages):
+    chunks = []
+    for msg in messages:
+        speaker = "User" if msg["role"] == "user" else "Assistant"
+        for part in split_text(msg["content"]):
+            chunks.append(f"{speaker}: {part}")
+    return chunks
+
+
+def memory_range(session):
+    # Живые номера кусков чата: старше MEMORY_MAX_CHUNKS от конца не ищутся и удаляются
+    end = session.get("memory_seq", 0)
+    return max(session.get("memory_start", 0), end - MEMORY_MAX_CHUNKS), end
+
+
+def reserve_chunks(session, chunks):
+    # Вызывается внутри обновления сессии: занимает номера под новые куски, сами тексты
+    # пишутся в ChunkStore после успешной записи сессии (повтор при гонке ничего не дублирует)
+    start = session.get("memory_seq", 0)
+    session["memory_seq"] = start + len(chunks)
+    return start
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS memory_chunks ("
+            " sid TEXT NOT NULL, seq INTEGER NOT NULL, text TEXT NOT NULL, PRIMARY KEY (sid, seq))"
+        )
+
+    def put(self, sid, start, texts):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO memory_chunks (sid, seq, text) VALUES (?, ?, ?)",
+                                [(sid, start + i, text) for i, text in enumerate(texts)])
+
+    def load(self, sid, start, end):
+        with self.lock:
+            return self.db.execute("SELECT seq, text FROM memory_chunks WHERE sid = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                                   (sid, start, end)).fetchall()
+
+    def texts(self, sid, seqs):
+        if not seqs:
+            return {}
+        with self.lock:
+            rows = self.db.execute(f"SELECT seq, text FROM memory_chunks WHERE sid = ? AND seq IN ({','.join('?' * len(seqs))})",
+                                   (sid, *seqs)).fetchall()
+        return dict(rows)
+
+    def trim(self, sid, start):
+        with self.lock:
+            self.db.execute("DELETE FROM memory_chunks WHERE sid = ? AND seq < ?", (sid, start))
+
+    def copy(self, old_sid, new_sid, start, end):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO memory_chunks (sid, seq, text)"
+                            " SELECT ?, seq, text FROM memory_chunks WHERE sid = ? AND seq >= ? AND seq < ?",
+                            (new_sid, old_sid, start, end))
+
+    def delete(self, sid):
+        with self.lock:
+            self.db.execute("DELETE FROM memory_chunks WHERE sid = ?", (sid,))
+
+
+class MemoryIndex:
+    # Векторы кусков по возрастанию seq: новые дописываются в конец, старые срезаются с начала
+    def __init__(self):
+        self.seqs = []
+        self.rows = []
+        self.matrix = None
+        self.end = 0
+
+    def extend(self, rows):
+        np = load_numpy()
+        vecs = [embed(text) for _, text in rows]
+        if np is not None:
+            block = np.zeros((len(vecs), MEMORY_DIM), dtype=np.float32)
+            for r, vec in enumerate(vecs):
+                block[r, list(vec)] = list(vec.values())
+            self.matrix = block if self.matrix is None else np.vstack((self.matrix, block))
+        else:
+            self.rows.extend(vecs)
+        self.seqs.extend(seq for seq, _ in rows)
+
+    def trim(self, start):
+        n = 0
+        while n < len(self.seqs) and self.seqs[n] < start:
+            n += 1
+        if not n:
+            return
+        del self.seqs[:n]
+        if self.matrix is not None:
+            self.matrix = self.matrix[n:].copy()
+        else:
+            del self.rows[:n]
+
+    def search(self, query, k):
+        np = load_numpy()
+        q = embed(query)
+        if not q or not self.seqs:
+            return []
+        if np is not None:
+            scores = self.matrix[:, list(q)] @ np.fromiter(q.values(), dtype=np.float32, count=len(q))
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            return sorted(((float(scores[i]), self.seqs[i]) for i in top), reverse=True)
+        scored = ((sum(v * row.get(i, 0.0) for i, v in q.items()), self.seqs[n]) for n, row in enumerate(self.rows))
+        return heapq.nlargest(k, scored)
+
+
+class MemoryStore:
+    # Индексы держатся в LRU по чатам и дочитывают из ChunkStore только новые куски.
+    # Векторизация и поиск идут в отдельном потоке, чтобы не держать цикл событий
+    def __init__(self, chunks, max_sessions=MEMORY_INDEX_CACHE):
+        self.chunks = chunks
+        self.max_sessions = max_sessions
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
+    def remember(self, sid, start, texts, live_start):
+        if texts:
+            self.chunks.put(sid, start, texts)
+        self.chunks.trim(sid, live_start)
+
+    def index(self, sid, start, end):
+        idx = self.indexes.get(sid)
+        if idx is None or idx.end > end:
+            idx = self.indexes[sid] = MemoryIndex()
+        idx.trim(start)
+        if max(idx.end, start) < end:
+            idx.extend(self.chunks.load(sid, max(idx.end, start), end))
+        idx.end = end
+        self.indexes.move_to_end(sid)
+        while len(self.indexes) > self.max_sessions:
+            self.indexes.popitem(last=False)
+        return idx
+
+    def search(self, sid, start, end, query, k, min_score):
+        with self.lock:
+            # С запасом: одинаковые куски из повторов в переписке не должны занять все места
+            hits = self.index(sid, start, end).search(query, k * 2)
+        seqs = [seq for score, seq in hits if score >= min_score]
+        texts = self.chunks.texts(sid, seqs)
+        recalled = []
+        for seq in seqs:
+            text = texts.get(seq)
+            if text is not None and text not in recalled:
+                recalled.append(text)
+        return recalled[:k]
+
+    async def recall(self, sid, session, query, k, min_score=0.1):
+        start, end = memory_range(session)
+        if start >= end or not query:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self.search, sid, start, end, query, k, min_score)
+
+    def forget(self, sid):
+        with self.lock:
+            self.indexes.pop(sid, None)
+
+    def drop(self, sid):
+        self.forget(sid)
+        self.chunks.delete(sid)
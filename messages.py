@@ -0,0 +1,86 @@
+import json
+import os
+import sys
+import zlib
+
+# Длинные тексты можно держать в памяти сжатыми: распаковка стоит долей миллисекунды
+MESSAGE_COMPRESSION = os.environ.get("MESSAGE_COMPRESSION", "") == "1"
+COMPRESS_MIN_CHARS = 4096
+# Так начинался сохранённый html сообщений об ошибке до появления флага error
+LEGACY_ERROR_PREFIX = "<p style='color:#ff6b6b'>"
+# Заголовок объекта со слотами, ссылки и счётчик токенов
+MESSAGE_OVERHEAD_BYTES = 120
+
+
+class Message:
+    # Компактная запись сообщения. HTML не хранится: он выводится из текста и кэшируется
+    # в ограниченном пуле mdrender. Доступ как к словарю (msg["role"], msg.get("tokens"))
+    # оставлен, чтобы сообщения и готовые к отправке dict обрабатывались одинаково
+    __slots__ = ("role", "body", "tokens", "error")
+
+    def __init__(self, role, content, tokens=None, error=False):
+        self.role = sys.intern(role)
+        if MESSAGE_COMPRESSION and len(content) >= COMPRESS_MIN_CHARS:
+            self.body = zlib.compress(content.encode("utf-8"), 6)
+        else:
+            self.body = content
+        self.tokens = tokens
+        self.error = error
+
+    @property
+    def content(self):
+        if isinstance(self.body, bytes):
+            return zlib.decompress(self.body).decode("utf-8")
+        return self.body
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.body) + MESSAGE_OVERHEAD_BYTES
+
+    def __getitem__(self, key):
+        if key == "content":
+            return self.content
+        if key in ("role", "tokens", "error"):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        # Снаружи меняется только кэш подсчёта токенов
+        if key != "tokens":
+            raise KeyError(key)
+        self.tokens = value
+
+    def to_dict(self):
+        data = {"role": self.role, "content": self.content}
+        if self.tokens:
+            data["tokens"] = self.tokens
+        if self.error:
+            data["error"] = True
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        error = data.get("error") or data.get("html", "").startswith(LEGACY_ERROR_PREFIX)
+        return cls(data["role"], data["content"], data.get("tokens"), bool(error))
+
+
+def encode_session(session):
+    return json.dumps(session, ensure_ascii=False, default=Message.to_dict)
+
+
+def decode_session(data):
+    session = json.loads(data)
+    session["messages"] = [Message.from_dict(m) for m in session.get("messages", [])]
+    return session
+
+
+def session_nbytes(session):
+    # Приблизительно: тела сообщений и саммари, без мелких полей
+    return sum(m.nbytes for m in session.get("messages", [])) + sum(sys.getsizeof(s) for s in session.get("summaries", []))
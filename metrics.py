@@ -0,0 +1,213 @@
+import bisect
+import os
+import time
+from contextlib import contextmanager
+
+# Границы бакетов в секундах: от рендера фрагмента до долгой генерации
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        for values, v in self.values.items():
+            yield self.name + format_labels(self.labels, values), v
+
+
+class Gauge:
+    kind = "gauge"
+
+    # Значение снимается в момент запроса /metrics, на горячем пути ничего не стоит
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for values, v in value.items():
+                yield self.name + format_labels(self.labels, values), v
+        else:
+            yield self.name, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labelvalues):
+        series = self.series.get(labelvalues)
+        if series is None:
+            series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + "_bucket" + format_labels(self.labels, values, [("le", bound)]), cumulative
+            cumulative += counts[-1]
+            yield self.name + "_bucket" + format_labels(self.labels, values, [("le", "+Inf")]), cumulative
+            yield self.name + "_sum" + format_labels(self.labels, values), total
+            yield self.name + "_count" + format_labels(self.labels, values), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self.register(Gauge(name, help, fn, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("chat_stage_seconds", "Время этапов обработки запроса", ("stage",))
+UPSTREAM_TTFT = registry.histogram("upstream_ttft_seconds", "Время до первого токена от модели", ("model",))
+UPSTREAM_SECONDS = registry.histogram("upstream_duration_seconds", "Полное время ответа модели", ("model",))
+UPSTREAM_ERRORS = registry.counter("upstream_errors_total", "Ошибки запросов к модели", ("model",))
+LLM_TOKENS = registry.counter("llm_tokens_total", "Токены по данным usage из API", ("model", "role", "kind"))
+PROMPT_PREFIX_TOKENS = registry.counter("prompt_prefix_tokens_total", "Токены промпта и их часть, не изменившаяся с прошлого хода", ("kind",))
+HTTP_SECONDS = registry.histogram("http_request_duration_seconds", "Время HTTP-запросов", ("method", "route", "status"))
+
+
+class Trace:
+    # Спаны одного запроса: пишутся в гистограмму и в заголовок Server-Timing
+    def __init__(self):
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            STAGE_SECONDS.observe(elapsed, stage)
+            self.spans.append((stage, elapsed))
+
+    def add(self, stage, elapsed):
+        STAGE_SECONDS.observe(elapsed, stage)
+        self.spans.append((stage, elapsed))
+
+    def timings(self):
+        return {stage: round(elapsed * 1000, 2) for stage, elapsed in self.spans}
+
+    def header(self):
+        return ", ".join(f"{stage};dur={elapsed * 1000:.2f}" for stage, elapsed in self.spans)
+
+
+def process_age():
+    # Сколько секунд назад запущен процесс — по /proc (Linux); иначе 0
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return max(0.0, float(f.read().split()[0]) - started)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupClock:
+    # Этапы холодного старта: длительности шагов и отметки от запуска процесса
+    def __init__(self):
+        self.process_started = time.monotonic() - process_age()
+        self.steps = {}
+        self.marks = {}
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, elapsed):
+        self.steps[name] = round(self.steps.get(name, 0.0) + elapsed, 4)
+
+    def mark(self, name):
+        # Повторные отметки не перезаписывают первую
+        self.marks.setdefault(name, round(time.monotonic() - self.process_started, 4))
+
+    def snapshot(self):
+        return {"steps": dict(self.steps), "since_process_start": dict(self.marks)}
+
+
+STARTUP = StartupClock()
+
+
+class MetricsMiddleware:
+    # Чистый ASGI, чтобы не буферизовать потоковые ответы
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if status[0] == 200:
+                    STARTUP.mark("first_200")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - started, scope["method"], path, status[0])
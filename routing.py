@@ -0,0 +1,155 @@
+import asyncio
+import time
+from collections import deque
+
+import anyio
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ModelHealth:
+    # Скользящее окно задержек и ошибок + предохранитель (circuit breaker)
+    def __init__(self, window=100, failure_threshold=3, error_rate=0.5, cooldown=30.0):
+        self.latencies = deque(maxlen=window)
+        self.ttfts = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.error_rate_limit = error_rate
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_success(self, latency, ttft=None):
+        self.latencies.append(latency)
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.consecutive_failures >= self.failure_threshold or (
+            len(self.outcomes) >= 10 and self.error_rate() > self.error_rate_limit
+        ):
+            self.opened_at = time.monotonic()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def available(self):
+        state = self.state()
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def begin(self):
+        # В полуоткрытом состоянии пропускаем только один пробный запрос
+        if self.state() == "half-open":
+            self.probing = True
+
+    def end(self):
+        # Попытка закончилась без исхода (отмена, лишний ответ хеджа) — проба снова разрешена
+        self.probing = False
+
+    def snapshot(self):
+        return {
+            "state": self.state(),
+            "requests": len(self.outcomes),
+            "error_rate": round(self.error_rate(), 4),
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p95": percentile(self.latencies, 0.95),
+            "ttft_p50": percentile(self.ttfts, 0.5),
+            "ttft_p95": percentile(self.ttfts, 0.95),
+        }
+
+
+class Router:
+    def __init__(self, fallbacks, hedge=False, hedge_min_delay=2.0, hedge_default_delay=10.0, hedge_min_samples=20):
+        self.fallbacks = fallbacks
+        self.health = {}
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+
+    def model(self, model_id):
+        if model_id not in self.health:
+            self.health[model_id] = ModelHealth()
+        return self.health[model_id]
+
+    def candidates(self, model_id):
+        chain = [model_id] + [m for m in self.fallbacks.get(model_id, []) if m != model_id]
+        alive = [m for m in chain if self.model(m).available()]
+        # Если все предохранители разомкнуты, всё равно пробуем выбранную модель
+        return alive or [model_id]
+
+    def hedge_delay(self, model_id, streaming):
+        samples = self.model(model_id).ttfts if streaming else self.model(model_id).latencies
+        if len(samples) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, percentile(samples, 0.95))
+
+    async def race(self, model_id, attempt, streaming, discard=None):
+        # attempt(model_id) -> результат; при ошибке идём по цепочке фолбэков,
+        # при хедже после p95 запускаем следующую модель и берём первый ответ
+        queue = self.candidates(model_id)
+        pending = {}
+        started = {}
+        last_error = None
+        winner = None
+        try:
+            while winner is None:
+                if not pending:
+                    if not queue:
+                        raise last_error or RuntimeError("Нет доступных моделей")
+                    mid = queue.pop(0)
+                    started[mid] = time.monotonic()
+                    self.model(mid).begin()
+                    pending[asyncio.ensure_future(attempt(mid))] = mid
+                timeout = None
+                if self.hedge and len(pending) == 1 and queue:
+                    current = next(iter(pending.values()))
+                    timeout = max(0.0, started[current] + self.hedge_delay(current, streaming) - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    mid = queue.pop(0)
+                    started[mid] = time.monotonic()
+                    self.model(mid).begin()
+                    pending[asyncio.ensure_future(attempt(mid))] = mid
+                    continue
+                for task in done:
+                    mid = pending.pop(task)
+                    if task.exception() is not None:
+                        self.model(mid).record_failure()
+                        last_error = task.exception()
+                    elif winner is None:
+                        winner = (mid, task.result(), time.monotonic() - started[mid])
+                    else:
+                        self.model(mid).end()
+                        if discard is not None:
+                            await discard(task.result())
+        finally:
+            for task, mid in pending.items():
+                task.cancel()
+                self.model(mid).end()
+            if pending:
+                with anyio.CancelScope(shield=True):
+                    await asyncio.gather(*pending, return_exceptions=True)
+        return winner
@@ -0,0 +1,22 @@
+window.onload=function(){scrollToBottom();document.getElementById('userInput').focus();hljs.highlightAll();const t=localStorage.getItem('theme')||'dark';if(t==='light'){document.documentElement.setAttribute('data-theme','light');document.querySelector('.theme-btn').textContent='☀️'}};
+function sessionId(){return document.querySelector('#chatForm input[name=session_id]').value}
+function scrollToBottom(){const c=document.getElementById('chatBox');c.scrollTop=c.scrollHeight}
+function showLoading(){document.getElementById('loading').style.display='block';const b=document.getElementById('sendBtn');b.disabled=true;b.style.opacity='0.5';const c=document.getElementById('chatBox');const w=c.querySelector('.welcome');if(w)w.remove();const i=document.getElementById('userInput');const d=document.createElement('div');d.className='message user-msg';d.innerHTML='<div class="avatar">👤</div><div class="bubble">'+escapeHtml(i.value)+'</div>';c.appendChild(d);scrollToBottom()}
+function hideLoading(){document.getElementById('loading').style.display='none';const b=document.getElementById('sendBtn');b.disabled=false;b.style.opacity='1'}
+function parseEvent(chunk){let ev='message',data='';chunk.split('\n').forEach(l=>{if(l.startsWith('event: '))ev=l.slice(7);else if(l.startsWith('data: '))data+=l.slice(6)});return {event:ev,data:data?JSON.parse(data):{}}}
+let busy=false;
+function newRequestId(){return window.crypto&&crypto.randomUUID?crypto.randomUUID():Date.now().toString(36)+Math.random().toString(36).slice(2)}
+async function sendMessage(e){if(!window.fetch||!window.ReadableStream)return showLoading();e.preventDefault();const f=document.getElementById('chatForm');const i=document.getElementById('userInput');if(busy||!i.value.trim())return;busy=true;const data=new FormData(f);showLoading();i.value='';const c=document.getElementById('chatBox');const d=document.createElement('div');d.className='message bot-msg';d.innerHTML='<div class="avatar">🤖</div><div class="bubble"><div class="markdown-content"></div><button class="copy-btn" onclick="copyMessage(this)" title="Скопировать">📋</button></div>';const m=d.querySelector('.markdown-content');m.innerHTML='<div class="md-stable"></div><div class="md-tail"></div><span class="md-raw"></span>';const st=m.querySelector('.md-stable'),tl=m.querySelector('.md-tail'),rw=m.querySelector('.md-raw');let raw='';let shown=false;try{const r=await fetch('/chat/stream',{method:'POST',body:data});if(r.status===429){const j=await r.json().catch(()=>({}));i.value=data.get('user_message');throw new Error(j.error||'HTTP 429')}f.elements.request_id.value=newRequestId();if(!r.ok||!r.body)throw new Error('HTTP '+r.status);const rd=r.body.getReader();const dec=new TextDecoder();let buf='';for(;;){const x=await rd.read();if(x.done)break;buf+=dec.decode(x.value,{stream:true});let k;while((k=buf.indexOf('\n\n'))>=0){const ev=parseEvent(buf.slice(0,k));buf=buf.slice(k+2);if(!shown){document.getElementById('loading').style.display='none';c.appendChild(d);shown=true}if(ev.event==='delta'){raw+=ev.data.text;rw.textContent=raw}else if(ev.event==='render'){st.insertAdjacentHTML('beforeend',ev.data.append);tl.innerHTML=ev.data.tail;raw='';rw.textContent=''}else{m.innerHTML=ev.data.html;m.querySelectorAll('pre code').forEach(el=>hljs.highlightElement(el));if(ev.data.tokens_total!==undefined)document.getElementById('tokenTotal').textContent=ev.data.tokens_total}scrollToBottom()}}}catch(err){if(!shown)c.appendChild(d);m.innerHTML='<p style="color:#ff6b6b">⚠️ Ошибка: '+escapeHtml(String(err))+'</p>'}hideLoading();busy=false;i.focus();refreshFragments()}
+function copyMessage(btn){const b=btn.closest('.bubble');const c=b.querySelector('.markdown-content');const t=c?c.innerText:b.innerText;navigator.clipboard.writeText(t).then(()=>{const toast=document.getElementById('copyToast');toast.classList.add('show');setTimeout(()=>toast.classList.remove('show'),2000)})}
+function toggleTheme(){const h=document.documentElement;const b=document.querySelector('.theme-btn');if(h.getAttribute('data-theme')==='light'){h.removeAttribute('data-theme');b.textContent='🌙';localStorage.setItem('theme','dark')}else{h.setAttribute('data-theme','light');b.textContent='☀️';localStorage.setItem('theme','light')}}
+function toggleSidebar(){const s=document.getElementById('sidebar');let o=document.querySelector('.sidebar-overlay');if(!o){o=document.createElement('div');o.className='sidebar-overlay';o.onclick=toggleSidebar;document.body.appendChild(o)};s.classList.toggle('open');o.classList.toggle('show')}
+function fillQuestion(t){document.getElementById('userInput').value=t;document.getElementById('userInput').focus()}
+function escapeHtml(t){const d=document.createElement('div');d.innerText=t;return d.innerHTML}
+async function refreshFragments(){const sid=sessionId();const [l,c]=await Promise.all([fetch(chatsUrl()),fetch('/fragments/context/'+encodeURIComponent(sid))]);if(l.ok)document.getElementById('chatList').innerHTML=await l.text();if(c.ok){const bar=document.getElementById('contextBar');const t=document.createElement('div');t.innerHTML=await c.text();if(bar&&t.firstElementChild)bar.replaceWith(t.firstElementChild)}}
+async function loadEarlier(btn){const r=await fetch('/fragments/messages/'+encodeURIComponent(sessionId())+'?before='+btn.dataset.before);if(!r.ok)return;const t=document.createElement('div');t.innerHTML=await r.text();t.querySelectorAll('pre code').forEach(el=>hljs.highlightElement(el));const next=r.headers.get('X-Next-Before');btn.after(...t.childNodes);if(next&&next!=='0')btn.dataset.before=next;else btn.remove()}
+function chatsUrl(before){const q=document.getElementById('chatSearch').value.trim();let u='/fragments/chats?current='+encodeURIComponent(sessionId());if(q)u+='&q='+encodeURIComponent(q);if(before)u+='&before='+before;return u}
+let searchTimer=null;
+function searchChats(){clearTimeout(searchTimer);searchTimer=setTimeout(async()=>{const r=await fetch(chatsUrl());if(r.ok)document.getElementById('chatList').innerHTML=await r.text()},200)}
+async function moreChats(btn){const r=await fetch(chatsUrl(btn.dataset.before));if(!r.ok)return;const t=document.createElement('div');t.innerHTML=await r.text();btn.replaceWith(...t.childNodes)}
+function watchMemory(){if(document.querySelector('.memory-pending'))setTimeout(async()=>{await refreshFragments();watchMemory()},3000)}
+watchMemory();
@@ -0,0 +1,266 @@
+import bisect
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from messages import decode_session, encode_session, session_nbytes
+
+UPDATE_RETRIES = 8
+
+
+class Conflict(Exception):
+    pass
+
+
+def session_meta(session):
+    return {
+        "title": session.get("title", "Новый чат"),
+        "msg_count": len(session.get("messages", [])),
+        "has_memory": bool(session.get("summaries")),
+        "continued_from": session.get("continued_from", ""),
+        "empty": not (session.get("messages") or session.get("summaries")),
+    }
+
+
+def title_key(title):
+    return (title or "").lower()
+
+
+class MemoryBackend:
+    # Для локальной разработки: один воркер, без диска
+    def __init__(self):
+        self.rows = {}
+        # Индексы непустых чатов: по времени активности и по названию
+        self.by_version = []
+        self.by_title = []
+
+    def load(self, sid):
+        row = self.rows.get(sid)
+        if row is None:
+            return None, 0
+        return decode_session(row[0]), row[1]
+
+    def version(self, sid):
+        row = self.rows.get(sid)
+        return row[1] if row else 0
+
+    def save(self, sid, session, expected=None):
+        # expected — версия, от которой сделано изменение (0 — чата не было); None — запись без проверки
+        if expected is not None and self.version(sid) != expected:
+            return None
+        version = time.time_ns()
+        meta = session_meta(session)
+        self.unindex(sid)
+        self.rows[sid] = (encode_session(session), version, meta)
+        if not meta["empty"]:
+            bisect.insort(self.by_version, (version, sid))
+            bisect.insort(self.by_title, (title_key(meta["title"]), version, sid))
+        return version
+
+    def delete(self, sid):
+        self.unindex(sid)
+        self.rows.pop(sid, None)
+
+    def unindex(self, sid):
+        row = self.rows.get(sid)
+        if row is None or row[2]["empty"]:
+            return
+        i = bisect.bisect_left(self.by_version, (row[1], sid))
+        del self.by_version[i]
+        i = bisect.bisect_left(self.by_title, (title_key(row[2]["title"]), row[1], sid))
+        del self.by_title[i]
+
+    def recent(self, limit, before=None, prefix=""):
+        if prefix:
+            key = title_key(prefix)
+            lo = bisect.bisect_left(self.by_title, (key,))
+            hi = bisect.bisect_left(self.by_title, (key + "\uffff",))
+            hits = sorted((v, sid) for _, v, sid in self.by_title[lo:hi] if before is None or v < before)
+            hits = hits[-limit:]
+        else:
+            hi = len(self.by_version) if before is None else bisect.bisect_left(self.by_version, (before,))
+            hits = self.by_version[max(0, hi - limit):hi]
+        return [dict(self.rows[sid][2], id=sid, version=v) for v, sid in reversed(hits)]
+
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL,"
+            " title TEXT, msg_count INTEGER, has_memory INTEGER, continued_from TEXT, empty INTEGER, title_key TEXT)"
+        )
+        columns = [r[1] for r in self.db.execute("PRAGMA table_info(sessions)")]
+        if "title_key" not in columns:
+            self.db.execute("ALTER TABLE sessions ADD COLUMN title_key TEXT")
+            rows = self.db.execute("SELECT id, title FROM sessions").fetchall()
+            self.db.executemany("UPDATE sessions SET title_key = ? WHERE id = ?", [(title_key(t), i) for i, t in rows])
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_recent ON sessions (empty, version)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_title ON sessions (empty, title_key)")
+
+    def load(self, sid):
+        with self.lock:
+            row = self.db.execute("SELECT data, version FROM sessions WHERE id = ?", (sid,)).fetchone()
+        if row is None:
+            return None, 0
+        return decode_session(row[0]), row[1]
+
+    def version(self, sid):
+        with self.lock:
+            row = self.db.execute("SELECT version FROM sessions WHERE id = ?", (sid,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, sid, session, expected=None):
+        # expected — версия, от которой сделано изменение (0 — чата не было); None — запись без проверки.
+        # Если строку успел переписать другой воркер, ничего не пишем и возвращаем None
+        version = time.time_ns()
+        meta = session_meta(session)
+        values = (encode_session(session), version, meta["title"], meta["msg_count"],
+                  int(meta["has_memory"]), meta["continued_from"], int(meta["empty"]), title_key(meta["title"]))
+        insert = ("INSERT INTO sessions (data, version, title, msg_count, has_memory, continued_from, empty, title_key, id)"
+                  " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        with self.lock:
+            if expected is None:
+                cur = self.db.execute(
+                    insert + " ON CONFLICT(id) DO UPDATE SET data = excluded.data, version = excluded.version,"
+                    " title = excluded.title, msg_count = excluded.msg_count, has_memory = excluded.has_memory,"
+                    " continued_from = excluded.continued_from, empty = excluded.empty, title_key = excluded.title_key",
+                    (*values, sid),
+                )
+            elif not expected:
+                cur = self.db.execute(insert + " ON CONFLICT(id) DO NOTHING", (*values, sid))
+            else:
+                cur = self.db.execute(
+                    "UPDATE sessions SET data = ?, version = ?, title = ?, msg_count = ?, has_memory = ?,"
+                    " continued_from = ?, empty = ?, title_key = ? WHERE id = ? AND version = ?",
+                    (*values, sid, expected),
+                )
+            if not cur.rowcount:
+                return None
+        return version
+
+    def delete(self, sid):
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def recent(self, limit, before=None, prefix=""):
+        where = "empty = 0"
+        args = []
+        if before is not None:
+            where += " AND version < ?"
+            args.append(before)
+        if prefix:
+            # Диапазон по индексу вместо LIKE: lower() в SQLite не знает кириллицу
+            key = title_key(prefix)
+            where += " AND title_key >= ? AND title_key < ?"
+            args += [key, key + "\uffff"]
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, title, msg_count, has_memory, continued_from, version FROM sessions"
+                f" WHERE {where} ORDER BY version DESC LIMIT ?", (*args, limit)
+            ).fetchall()
+        return [
+            {"id": r[0], "title": r[1], "msg_count": r[2], "has_memory": bool(r[3]), "continued_from": r[4], "empty": False, "version": r[5]}
+            for r in rows
+        ]
+
+
+class SessionStore:
+    # Горячий LRU/TTL-кэш поверх долговременного бэкенда.
+    # Версия строки сверяется при каждом чтении, поэтому несколько воркеров
+    # видят изменения друг друга, а JSON декодируется только при промахе.
+    # Кэш ограничен и числом чатов, и байтами: холодные переписки вытесняются
+    # в бэкенд, а слишком большие чаты в горячий кэш не попадают вовсе.
+    def __init__(self, backend, max_hot=512, ttl=900, max_bytes=0, max_session_bytes=0):
+        self.backend = backend
+        self.max_hot = max_hot
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self.hot = OrderedDict()
+        self.hot_bytes = 0
+
+    def get(self, sid):
+        return self.load(sid)[0]
+
+    def load(self, sid):
+        now = time.monotonic()
+        entry = self.hot.get(sid)
+        if entry is not None:
+            session, version, seen, nbytes = entry
+            if now - seen < self.ttl and self.backend.version(sid) == version:
+                self.hot[sid] = (session, version, now, nbytes)
+                self.hot.move_to_end(sid)
+                return session, version
+            self.forget(sid)
+        session, version = self.backend.load(sid)
+        if session is not None:
+            self.remember(sid, session, version)
+        return session, version
+
+    def peek(self, sid):
+        # Чтение без записи в горячий кэш — для массового обхода вроде экспорта
+        entry = self.hot.get(sid)
+        if entry is not None and self.backend.version(sid) == entry[1]:
+            return entry[0]
+        return self.backend.load(sid)[0]
+
+    def put(self, sid, session):
+        # Без проверки версии — только для чатов, которые больше никто не пишет (новый id)
+        version = self.backend.save(sid, session)
+        self.remember(sid, session, version)
+
+    def update(self, sid, mutate):
+        # Чтение-изменение-запись с проверкой версии: воркеры не затирают записи друг друга.
+        # mutate(session) получает свежую сессию (None — чата нет) и возвращает то, что
+        # записать, или None, если писать не нужно. При гонке сессия перечитывается
+        # и mutate применяется заново
+        for _ in range(UPDATE_RETRIES):
+            session, version = self.load(sid)
+            session = mutate(session)
+            if session is None:
+                return None
+            saved = self.backend.save(sid, session, expected=version)
+            if saved is not None:
+                self.remember(sid, session, saved)
+                return session
+            # Объект в кэше уже изменён, но не записан — выбрасываем его
+            self.forget(sid)
+        raise Conflict(sid)
+
+    def delete(self, sid):
+        self.forget(sid)
+        self.backend.delete(sid)
+
+    def recent(self, limit=20, before=None, prefix=""):
+        return self.backend.recent(limit, before, prefix)
+
+    def remember(self, sid, session, version):
+        self.forget(sid)
+        nbytes = session_nbytes(session)
+        if self.max_session_bytes and nbytes > self.max_session_bytes:
+            return
+        self.hot[sid] = (session, version, time.monotonic(), nbytes)
+        self.hot_bytes += nbytes
+        while len(self.hot) > self.max_hot or (self.max_bytes and self.hot_bytes > self.max_bytes and len(self.hot) > 1):
+            _, entry = self.hot.popitem(last=False)
+            self.hot_bytes -= entry[3]
+
+    def forget(self, sid):
+        entry = self.hot.pop(sid, None)
+        if entry is not None:
+            self.hot_bytes -= entry[3]
+
+
+def open_store(url, max_hot=512, ttl=900, max_bytes=0, max_session_bytes=0):
+    if url in ("", "memory", ":memory:"):
+        backend = MemoryBackend()
+    else:
+        backend = SQLiteBackend(url.removeprefix("sqlite:///"))
+    return SessionStore(backend, max_hot=max_hot, ttl=ttl, max_bytes=max_bytes, max_session_bytes=max_session_bytes)
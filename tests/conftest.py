@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули приложения лежат в корне репозитория, без пакета
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from admission import FairScheduler, Overloaded, RateLimiter
+
+
+def test_granted_then_cancelled_slot_is_released():
+    async def scenario():
+        scheduler = FairScheduler(capacity=1, max_queue=10, max_wait=10)
+        acquired = await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.depth() == 1
+        # Слот отдан ожидающему, но тот отменён раньше, чем успел проснуться
+        scheduler.release(acquired)
+        assert scheduler.active == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return scheduler.active, scheduler.depth()
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler(capacity=1, max_queue=10, max_wait=10)
+        acquired = await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        depth = scheduler.depth()
+        scheduler.release(acquired)
+        return depth, scheduler.active
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_light_flow_is_served_before_heavy():
+    async def scenario():
+        scheduler = FairScheduler(capacity=1, max_queue=10, max_wait=10)
+        acquired = await scheduler.acquire("heavy")
+        order = []
+
+        async def request(flow):
+            started = await scheduler.acquire(flow)
+            order.append(flow)
+            scheduler.release(started)
+
+        tasks = [asyncio.create_task(request(flow)) for flow in ("heavy", "heavy", "light")]
+        await asyncio.sleep(0)
+        scheduler.release(acquired)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["light", "heavy", "heavy"]
+
+
+def test_full_queue_is_rejected():
+    async def scenario():
+        scheduler = FairScheduler(capacity=1, max_queue=1, max_wait=10)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(Overloaded) as exc:
+                await scheduler.acquire("c")
+            return exc.value.reason
+        finally:
+            waiter.cancel()
+
+    assert asyncio.run(scenario()) == "queue_full"
+
+
+def test_rate_limiter_allows_burst_then_rejects():
+    limiter = RateLimiter(per_minute=60, burst=3)
+    for _ in range(3):
+        limiter.check("a")
+    with pytest.raises(Overloaded) as exc:
+        limiter.check("a")
+    assert exc.value.reason == "rate_limit"
+    assert exc.value.retry_after == 1
+    # У другого пользователя своё ведро
+    limiter.check("b")
+
+
+def test_rate_limiter_disabled_with_zero_rate():
+    limiter = RateLimiter(per_minute=0, burst=1)
+    for _ in range(10):
+        limiter.check("a")
+
+
+def test_rate_limiter_evicts_oldest_keys():
+    limiter = RateLimiter(per_minute=60, burst=1, max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.check(key)
+    assert list(limiter.buckets) == ["b", "c"]
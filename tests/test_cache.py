@@ -0,0 +1,22 @@
+from cache import cache_key
+
+
+def key(content):
+    return cache_key("m", [{"role": "user", "content": content}], 0.7)
+
+
+def test_meaningful_differences_change_key():
+    assert key("if x:\n    return 1\nreturn 2") != key("if x:\n    return 1\n    return 2")
+    assert key("rename X to x") != key("rename x to X")
+    assert key("a  b") != key("a b")
+
+
+def test_edges_and_line_endings_are_ignored():
+    assert key("  hello\r\nworld \n") == key("hello\nworld")
+    assert key("hello\rworld") == key("hello\nworld")
+
+
+def test_model_and_temperature_are_part_of_key():
+    messages = [{"role": "user", "content": "hi"}]
+    assert cache_key("a", messages, 0.7) != cache_key("b", messages, 0.7)
+    assert cache_key("a", messages, 0.7) != cache_key("a", messages, 0.3)
@@ -0,0 +1,156 @@
+import asyncio
+
+from coalesce import SingleFlight
+
+
+async def collect(flight):
+    return [event async for event in flight.follow()]
+
+
+def test_duplicate_joins_running_flight():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = 0
+
+        async def run(flight):
+            nonlocal calls
+            calls += 1
+            flight.publish("a")
+            await release.wait()
+            flight.publish("b")
+
+        first = flights.start("k", run)
+        reader = asyncio.create_task(collect(first))
+        await asyncio.sleep(0)
+        second = flights.get("k")
+        joined = asyncio.create_task(collect(second))
+        await asyncio.sleep(0)
+        release.set()
+        return first is second, calls, await reader, await joined
+
+    same, calls, a, b = asyncio.run(scenario())
+    assert same and calls == 1
+    assert a == b == ["a", "b"]
+
+
+def test_last_subscriber_leaving_cancels_run():
+    async def scenario():
+        flights = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def run(flight):
+            flight.publish("a")
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        flight = flights.start("k", run)
+        readers = [flight.follow() for _ in range(2)]
+        for reader in readers:
+            assert await anext(reader) == "a"
+        await readers[0].aclose()
+        await asyncio.sleep(0)
+        still_running = not cancelled.is_set()
+        await readers[1].aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return still_running, flight.done, len(flights)
+
+    still_running, done, running = asyncio.run(scenario())
+    assert still_running
+    assert done and running == 0
+
+
+def test_replay_after_finish_within_linger():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def run(flight):
+            flight.publish("a")
+            flight.publish("b")
+
+        flight = flights.start("k", run, linger=60)
+        await flight.task
+        late = flights.get("k")
+        return late is flight, await collect(late)
+
+    same, events = asyncio.run(scenario())
+    assert same
+    assert events == ["a", "b"]
+
+
+def test_replay_after_finish_is_compacted():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def events():
+            for n in (1, 2, 3):
+                yield f"render {n}", f"render {n} light"
+                await asyncio.sleep(0)
+            yield "done"
+
+        flight = flights.start("k", lambda f: f.drain(events()), linger=60, compact=lambda evs: evs[-1:])
+        reader = asyncio.create_task(collect(flight))
+        await flight.task
+        return await reader, await collect(flights.get("k"))
+
+    live, late = asyncio.run(scenario())
+    assert live == ["render 1", "render 2", "render 3", "done"]
+    assert late == ["done"]
+
+
+def test_superseded_events_are_lightened():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def run(flight):
+            flight.publish("render 1", "render 1 light")
+            flight.publish("render 2", "render 2 light")
+            await release.wait()
+
+        flight = flights.start("k", run)
+        await asyncio.sleep(0)
+        log = list(flight.events)
+        release.set()
+        await flight.task
+        return log
+
+    assert asyncio.run(scenario()) == ["render 1 light", "render 2"]
+
+
+def test_expired_flight_is_not_joined():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def run(flight):
+            flight.publish("a")
+
+        flight = flights.start("k", run)
+        await flight.task
+        return flights.get("k")
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_finished_flights_are_pruned_without_new_start():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def run(flight):
+            flight.publish("result")
+
+        flights.start("job", run, compact=lambda events: [])
+        lingering = flights.start("turn", run, linger=0.05)
+        await asyncio.sleep(0.01)
+        first = sorted(flights.flights)
+        await asyncio.sleep(0.1)
+        return first, sorted(flights.flights), lingering.events
+
+    first, later, events = asyncio.run(scenario())
+    assert first == ["turn"]
+    assert later == []
+    assert events == ["result"]
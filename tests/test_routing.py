@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+import pytest
+
+from routing import ModelHealth, Router
+
+
+def tripped(cooldown=30.0):
+    health = ModelHealth(failure_threshold=1, cooldown=cooldown)
+    health.record_failure()
+    return health
+
+
+def test_falls_back_on_error():
+    router = Router({"a": ["b"]})
+    calls = []
+
+    async def attempt(model_id):
+        calls.append(model_id)
+        if model_id == "a":
+            raise RuntimeError("down")
+        return "ok"
+
+    model_id, result, _ = asyncio.run(router.race("a", attempt, streaming=False))
+    assert (model_id, result) == ("b", "ok")
+    assert calls == ["a", "b"]
+    assert router.model("a").outcomes[-1] is False
+
+
+def test_raises_last_error_when_chain_fails():
+    router = Router({"a": ["b"]})
+
+    async def attempt(model_id):
+        raise RuntimeError(model_id)
+
+    with pytest.raises(RuntimeError, match="b"):
+        asyncio.run(router.race("a", attempt, streaming=False))
+
+
+def test_hedge_starts_after_delay_and_discards_loser():
+    router = Router({"a": ["b"]}, hedge=True, hedge_default_delay=0.05)
+    started = {}
+    discarded = []
+
+    async def attempt(model_id):
+        started[model_id] = time.monotonic()
+        await asyncio.sleep(0.5 if model_id == "a" else 0.01)
+        return model_id
+
+    async def discard(result):
+        discarded.append(result)
+
+    begin = time.monotonic()
+    model_id, result, _ = asyncio.run(router.race("a", attempt, streaming=True, discard=discard))
+    assert (model_id, result) == ("b", "b")
+    assert 0.04 <= started["b"] - begin < 0.3
+    # Медленная модель отменена, а не дождана
+    assert time.monotonic() - begin < 0.4
+    assert discarded == []
+
+
+def test_no_hedge_before_delay():
+    router = Router({"a": ["b"]}, hedge=True, hedge_default_delay=1.0)
+    calls = []
+
+    async def attempt(model_id):
+        calls.append(model_id)
+        await asyncio.sleep(0.01)
+        return model_id
+
+    assert asyncio.run(router.race("a", attempt, streaming=False))[0] == "a"
+    assert calls == ["a"]
+
+
+def test_open_breaker_skips_model():
+    router = Router({"a": ["b"]})
+    router.health["a"] = tripped()
+    assert router.candidates("a") == ["b"]
+
+
+def test_half_open_lets_one_probe_through():
+    router = Router({"a": ["b"]})
+    router.health["a"] = tripped(cooldown=0.0)
+    assert router.model("a").state() == "half-open"
+    router.model("a").begin()
+    assert router.candidates("a") == ["b"]
+    router.model("a").record_success(0.1)
+    assert router.model("a").state() == "closed"
+    assert router.candidates("a") == ["a", "b"]
+
+
+def test_probe_without_outcome_is_released():
+    # Пробный поток выиграл гонку, но клиент ушёл раньше, чем исход записан
+    router = Router({"a": ["b"]})
+    router.health["a"] = tripped(cooldown=0.0)
+
+    async def attempt(model_id):
+        return model_id
+
+    assert asyncio.run(router.race("a", attempt, streaming=True))[0] == "a"
+    assert router.candidates("a") == ["b"]
+    router.model("a").end()
+    assert router.candidates("a") == ["a", "b"]
+
+
+def test_cancelled_race_releases_probe():
+    router = Router({"a": ["b"]})
+    router.health["a"] = tripped(cooldown=0.0)
+
+    async def attempt(model_id):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        task = asyncio.create_task(router.race("a", attempt, streaming=True))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert router.candidates("a") == ["a", "b"]
@@ -0,0 +1,153 @@
+import pytest
+
+from messages import Message
+from store import UPDATE_RETRIES, Conflict, MemoryBackend, SessionStore, SQLiteBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(str(tmp_path / "sessions.db"))
+
+
+def chat(title, *texts):
+    return {"title": title, "messages": [Message("user", t) for t in texts], "summaries": []}
+
+
+def texts(session):
+    return [m["content"] for m in session["messages"]]
+
+
+def append(text):
+    def apply(session):
+        session["messages"].append(Message("user", text))
+        return session
+    return apply
+
+
+def test_lost_race_reapplies_mutate(backend):
+    # Два воркера над одной базой: второй пишет, пока первый держит прочитанную версию
+    a, b = SessionStore(backend), SessionStore(backend)
+    a.put("s", chat("t"))
+    calls = []
+
+    def apply(session):
+        calls.append(texts(session))
+        if len(calls) == 1:
+            b.update("s", append("from b"))
+        session["messages"].append(Message("user", "from a"))
+        return session
+
+    a.update("s", apply)
+    assert calls == [[], ["from b"]]
+    assert texts(backend.load("s")[0]) == ["from b", "from a"]
+    assert texts(b.get("s")) == ["from b", "from a"]
+
+
+def test_expected_zero_fails_when_row_exists(backend):
+    assert backend.save("s", chat("first"), expected=0) is not None
+    assert backend.save("s", chat("second"), expected=0) is None
+    assert backend.load("s")[0]["title"] == "first"
+
+
+def test_stale_version_is_rejected(backend):
+    version = backend.save("s", chat("t"))
+    assert backend.save("s", chat("t", "x"), expected=version) is not None
+    assert backend.save("s", chat("t", "y"), expected=version) is None
+    assert texts(backend.load("s")[0]) == ["x"]
+
+
+def test_concurrent_create_reapplies_on_existing_row(backend):
+    a, b = SessionStore(backend), SessionStore(backend)
+    calls = []
+
+    def apply(session):
+        calls.append(session is None)
+        if session is None:
+            b.put("s", chat("other", "from b"))
+            session = chat("mine")
+        session["messages"].append(Message("user", "from a"))
+        return session
+
+    a.update("s", apply)
+    assert calls == [True, False]
+    session = backend.load("s")[0]
+    assert session["title"] == "other"
+    assert texts(session) == ["from b", "from a"]
+
+
+def test_dirty_hot_entry_is_discarded_on_conflict(backend):
+    a, b = SessionStore(backend), SessionStore(backend)
+    a.put("s", chat("t"))
+    stale = a.get("s")
+
+    def apply(session):
+        session["messages"].append(Message("user", "never saved"))
+        return session
+
+    b.update("s", append("from b"))
+    # Версия в кэше a сверяется при чтении — устаревший объект не используется
+    a.update("s", append("from a"))
+    assert texts(stale) == []
+    assert texts(a.get("s")) == ["from b", "from a"]
+
+    calls = []
+
+    def conflicting(session):
+        calls.append(session)
+        b.update("s", append("b again"))
+        return apply(session)
+
+    with pytest.raises(Conflict):
+        a.update("s", conflicting)
+    assert len(calls) == UPDATE_RETRIES
+    assert "s" not in a.hot
+    assert "never saved" not in texts(a.get("s"))
+
+
+def test_update_skips_write_when_mutate_returns_none(backend):
+    store = SessionStore(backend)
+    store.put("s", chat("t"))
+    version = backend.version("s")
+    assert store.update("s", lambda session: None) is None
+    assert store.update("missing", lambda session: None) is None
+    assert backend.version("s") == version
+    assert backend.load("missing")[0] is None
+
+
+def test_recent_follows_resaves_deletes_and_empty_chats(backend):
+    for sid, title in [("a", "Alpha"), ("b", "Beta"), ("c", "alpine")]:
+        backend.save(sid, chat(title, "hi"))
+    backend.save("e", chat("Empty"))
+    assert [c["id"] for c in backend.recent(10)] == ["c", "b", "a"]
+
+    # Повторная запись переносит чат наверх, старые позиции в индексах не остаются
+    backend.save("a", chat("Alps", "hi", "again"))
+    assert [c["id"] for c in backend.recent(10)] == ["a", "c", "b"]
+    assert backend.recent(1)[0]["msg_count"] == 2
+
+    page = backend.recent(2)
+    assert [c["id"] for c in page] == ["a", "c"]
+    assert [c["id"] for c in backend.recent(2, before=page[-1]["version"])] == ["b"]
+
+    assert [c["id"] for c in backend.recent(10, prefix="AL")] == ["a", "c"]
+    assert [c["id"] for c in backend.recent(10, prefix="alp")] == ["a", "c"]
+    assert [c["id"] for c in backend.recent(10, prefix="alph")] == []
+
+    backend.delete("c")
+    backend.save("b", chat("Beta"))
+    assert [c["id"] for c in backend.recent(10)] == ["a"]
+    assert backend.recent(10, prefix="be") == []
+
+
+def test_memory_indexes_stay_in_sync():
+    backend = MemoryBackend()
+    for i in range(20):
+        backend.save(f"s{i % 5}", chat(f"t{i % 3}", "x"))
+    backend.delete("s0")
+    backend.save("s1", chat("t"))
+    live = {sid for sid, row in backend.rows.items() if not row[2]["empty"]}
+    assert {sid for _, sid in backend.by_version} == live
+    assert {sid for _, _, sid in backend.by_title} == live
+    assert backend.by_version == sorted((row[1], sid) for sid, row in backend.rows.items() if sid in live)
@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenizers"))
+
+# Служебные токены шаблона чата на каждое сообщение
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_tokenizers = {}
+_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return int(len(text) * 0.33)
+
+
+def tokenizer_repo(model_id):
+    # "Qwen/Qwen3-Coder-Next:novita" -> "Qwen/Qwen3-Coder-Next"
+    return model_id.split(":", 1)[0]
+
+
+def tokenizer_path(model_id):
+    return os.path.join(TOKENIZER_DIR, tokenizer_repo(model_id).replace("/", "--"), "tokenizer.json")
+
+
+def get_tokenizer(model_id):
+    if Tokenizer is None or not model_id:
+        return None
+    if model_id not in _tokenizers:
+        with _lock:
+            if model_id not in _tokenizers:
+                path = tokenizer_path(model_id)
+                _tokenizers[model_id] = Tokenizer.from_file(path) if os.path.exists(path) else None
+    return _tokenizers[model_id]
+
+
+def tokenizer_name(model_id):
+    # Ключ кэша: счёт по словарю модели и по эвристике не смешиваются
+    return tokenizer_repo(model_id) if get_tokenizer(model_id) is not None else "estimate"
+
+
+def count_tokens(text, model_id=None):
+    if not text:
+        return 0
+    tokenizer = get_tokenizer(model_id)
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def message_tokens(msg, model_id=None):
+    # Счёт кэшируется прямо в сообщении и сохраняется вместе с сессией
+    name = tokenizer_name(model_id)
+    cached = msg.get("tokens")
+    if cached and cached[0] == name:
+        return cached[1]
+    n = count_tokens(msg.get("content", ""), model_id) + MESSAGE_OVERHEAD_TOKENS
+    msg["tokens"] = [name, n]
+    return n
+
+
+def count_history_tokens(messages, model_id=None):
+    return sum(message_tokens(msg, model_id) for msg in messages)
+
+
+def download(model_ids, token=""):
+    import httpx
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    for model_id in model_ids:
+        path = tokenizer_path(model_id)
+        if os.path.exists(path):
+            continue
+        url = f"https://huggingface.co/{tokenizer_repo(model_id)}/resolve/main/tokenizer.json"
+        try:
+            r = httpx.get(url, headers=headers, follow_redirects=True, timeout=60)
+        except httpx.HTTPError as e:
+            print(f"{model_id}: {e}, будет использована оценка")
+            continue
+        if r.status_code != 200:
+            print(f"{model_id}: HTTP {r.status_code}, будет использована оценка")
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(r.content)
+        print(f"{model_id}: {path}")
+
+
+if __name__ == "__main__":
+    # python tokens.py download — скачать словари всех моделей из MODELS
+    if sys.argv[1:2] == ["download"]:
+        from main import MODELS
+        download(MODELS.values(), os.environ.get("HF_TOKEN", ""))